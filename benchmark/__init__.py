@@ -0,0 +1,12 @@
+'''Offline benchmarks of the pool hot paths.
+
+Benchmarks run on a plain Linux box without coin daemon or MySQL,
+both are replaced by local stubs (see benchmark.stubs). Run them
+from the root of the repository, e.g.:
+
+    python -m benchmark.submit_bench --shares 50000 --hashing process
+    python -m benchmark.rpc_bench --calls 2000
+
+benchmark.stub_daemon also runs standalone as a JSON-RPC coin daemon
+the pool can connect to.
+'''
@@ -0,0 +1,164 @@
+'''Micro-benchmark of 256/320-bit codecs in lib.util.
+
+Before timing, current codecs are checked against the original
+word-by-word implementations on random values (round trip and
+identical results, including values out of range).
+
+    python -m benchmark.codec_bench --rounds 100000
+'''
+
+import argparse
+import os
+import random
+import StringIO
+import struct
+import timeit
+
+from benchmark import stubs
+
+# Original implementations, used as reference
+
+def legacy_uint320_from_str(s):
+    r = 0L
+    t = struct.unpack("<IIIIIIIIII", s[:40])
+    for i in xrange(10):
+        r += t[i] << (i * 32)
+    return r
+
+def legacy_uint320_from_str_be(s):
+    r = 0L
+    t = struct.unpack(">IIIIIIIIII", s[:40])
+    for i in xrange(10):
+        r += t[i] << (i * 32)
+    return r
+
+def legacy_uint256_from_str(s):
+    r = 0L
+    t = struct.unpack("<IIIIIIII", s[:32])
+    for i in xrange(8):
+        r += t[i] << (i * 32)
+    return r
+
+def legacy_uint256_from_str_be(s):
+    r = 0L
+    t = struct.unpack(">IIIIIIII", s[:32])
+    for i in xrange(8):
+        r += t[i] << (i * 32)
+    return r
+
+def legacy_ser_uint320(u):
+    rs = ""
+    for i in xrange(10):
+        rs += struct.pack("<I", u & 0xFFFFFFFFL)
+        u >>= 32
+    return rs
+
+def legacy_ser_uint256(u):
+    rs = ""
+    for i in xrange(8):
+        rs += struct.pack("<I", u & 0xFFFFFFFFL)
+        u >>= 32
+    return rs
+
+def legacy_ser_uint320_be(u):
+    rs = ""
+    for i in xrange(10):
+        rs += struct.pack(">I", u & 0xFFFFFFFFL)
+        u >>= 32
+    return rs
+
+def legacy_ser_uint256_be(u):
+    rs = ""
+    for i in xrange(8):
+        rs += struct.pack(">I", u & 0xFFFFFFFFL)
+        u >>= 32
+    return rs
+
+def legacy_deser_uint320(f):
+    r = 0L
+    for i in xrange(10):
+        t = struct.unpack("<I", f.read(4))[0]
+        r += t << (i * 32)
+    return r
+
+def legacy_deser_uint256(f):
+    r = 0L
+    for i in xrange(8):
+        t = struct.unpack("<I", f.read(4))[0]
+        r += t << (i * 32)
+    return r
+
+def random_values(count):
+    values = [0, 1, 2**32 - 1, 2**32, 2**256 - 1, 2**256, 2**320 - 1, 2**320, 2**400 + 12345, -1, -2**300]
+    for _ in xrange(count):
+        bits = random.choice((8, 32, 64, 255, 256, 319, 320))
+        values.append(random.getrandbits(bits))
+    return values
+
+def check(util, count):
+    '''Property checks of current codecs against legacy ones'''
+    for u in random_values(count):
+        for (new, old) in ((util.ser_uint320, legacy_ser_uint320), (util.ser_uint256, legacy_ser_uint256),
+                           (util.ser_uint320_be, legacy_ser_uint320_be), (util.ser_uint256_be, legacy_ser_uint256_be)):
+            assert new(u) == old(u), (new.__name__, u)
+
+        s320 = util.ser_uint320(u)
+        s256 = util.ser_uint256(u)
+        # Round trip, values out of range are truncated like before
+        assert util.uint320_from_str(s320) == u & util.MASK320
+        assert util.uint256_from_str(s256) == u & util.MASK256
+        assert util.deser_uint320(StringIO.StringIO(s320)) == u & util.MASK320
+        assert util.deser_uint256(StringIO.StringIO(s256)) == u & util.MASK256
+
+    for _ in xrange(count):
+        s = os.urandom(random.choice((40, 41, 64)))
+        for (new, old) in ((util.uint320_from_str, legacy_uint320_from_str),
+                           (util.uint320_from_str_be, legacy_uint320_from_str_be),
+                           (util.uint256_from_str, legacy_uint256_from_str),
+                           (util.uint256_from_str_be, legacy_uint256_from_str_be)):
+            (a, b) = (new(s), old(s))
+            assert a == b and type(a) == type(b), (new.__name__, s)
+        assert util.deser_uint320(StringIO.StringIO(s)) == legacy_deser_uint320(StringIO.StringIO(s))
+        assert util.deser_uint256(StringIO.StringIO(s)) == legacy_deser_uint256(StringIO.StringIO(s))
+
+    # Short strings are rejected with struct.error like before
+    for (f, size) in ((util.uint320_from_str, 40), (util.uint320_from_str_be, 40),
+                      (util.uint256_from_str, 32), (util.uint256_from_str_be, 32)):
+        for short in ('', 'x' * (size - 1)):
+            try:
+                f(short)
+            except struct.error:
+                continue
+            raise AssertionError("%s accepted short string" % f.__name__)
+
+def main():
+    parser = argparse.ArgumentParser(description='Micro-benchmark of 256/320-bit codecs.')
+    parser.add_argument('--rounds', type=int, default=100000)
+    parser.add_argument('--checks', type=int, default=20000, help='random values for property checks')
+    args = parser.parse_args()
+
+    stubs.setup_offline()
+    import lib.util as util
+
+    check(util, args.checks)
+    print "Property checks passed (%d random values)" % args.checks
+
+    value = random.getrandbits(320)
+    s = util.ser_uint320(value)
+    cases = (
+        ('uint320_from_str', lambda: legacy_uint320_from_str(s), lambda: util.uint320_from_str(s)),
+        ('uint256_from_str', lambda: legacy_uint256_from_str(s), lambda: util.uint256_from_str(s)),
+        ('ser_uint320', lambda: legacy_ser_uint320(value), lambda: util.ser_uint320(value)),
+        ('ser_uint256', lambda: legacy_ser_uint256(value), lambda: util.ser_uint256(value)),
+        ('deser_uint320', lambda: legacy_deser_uint320(StringIO.StringIO(s)),
+                          lambda: util.deser_uint320(StringIO.StringIO(s))),
+    )
+
+    print "%-20s %12s %12s %8s" % ('codec', 'old us/op', 'new us/op', 'speedup')
+    for (name, old, new) in cases:
+        t_old = timeit.timeit(old, number=args.rounds) / args.rounds * 1000000
+        t_new = timeit.timeit(new, number=args.rounds) / args.rounds * 1000000
+        print "%-20s %12.03f %12.03f %7.02fx" % (name, t_old, t_new, t_old / t_new)
+
+if __name__ == '__main__':
+    main()
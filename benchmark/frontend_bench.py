@@ -0,0 +1,221 @@
+'''Check of the multi-process mode (mining.supervisor).
+
+Runs a supervisor against the stub daemon, which spawns front-ends
+running this script again. Every front-end submits valid, invalid,
+duplicate and stale shares through MiningService; the supervisor checks
+that the share records reach its share manager, that a new block
+notified to one front-end is pushed to all of them, that calls outside
+RPC_METHODS are refused and that a killed front-end is restarted.
+
+    python -m benchmark.frontend_bench --frontends 2 --shares 500
+'''
+
+import argparse
+import binascii
+import os
+import shutil
+import signal
+import struct
+import sys
+import tempfile
+import time
+import weakref
+
+from benchmark import stubs, stub_daemon
+from benchmark.submit_bench import SubmitBench, create_connections
+
+def wait_for(condition, timeout):
+    '''Fires with the result of condition() once it is true, or False after timeout seconds'''
+    from twisted.internet import defer, reactor, task
+
+    @defer.inlineCallbacks
+    def _wait():
+        deadline = time.time() + timeout
+        while not condition():
+            if time.time() > deadline:
+                defer.returnValue(False)
+            yield task.deferLater(reactor, 0.05, lambda: None)
+        defer.returnValue(True)
+    return _wait()
+
+def setup_interfaces():
+    from mining.interfaces import Interfaces, WorkerManagerInterface, \
+                                  ShareLimiterInterface, TimestamperInterface
+    Interfaces.set_timestamper(TimestamperInterface())
+    Interfaces.set_worker_manager(WorkerManagerInterface())
+    Interfaces.set_share_limiter(ShareLimiterInterface())
+
+class ShareRecorder(object):
+    '''Share manager of the supervisor, keeps the forwarded records'''
+    def __init__(self):
+        self.shares = []
+        self.blocks = []
+
+    def on_network_block(self):
+        pass
+
+    def on_submit_share(self, worker_name, block_hash, difficulty, timestamp, is_valid, ip, invalid_reason, share_diff, job_id):
+        self.shares.append((ip.split('.')[1], is_valid))
+
+    def on_submit_block(self, is_accepted, worker_name, block_hash, timestamp, ip, share_diff):
+        self.blocks.append(block_hash)
+
+    def count(self, instance_id):
+        return len([ s for s in self.shares if s[0] == str(instance_id) ])
+
+def run_supervisor(args):
+    from twisted.internet import defer, reactor
+    import lib.settings as settings
+    from mining.interfaces import Interfaces
+    from mining import supervisor
+    from lib.bitcoin_rpc import BitcoinRPC
+    from lib.template_registry import TemplateRegistry
+    from lib.block_template import BlockTemplate
+
+    setup_interfaces()
+    recorder = ShareRecorder()
+    Interfaces.set_share_manager(recorder)
+
+    (daemon, port) = stub_daemon.listen(stubs.build_template(args.txs))
+    rpc = BitcoinRPC('127.0.0.1', port.getHost().port, 'user', 'pass')
+    factory = supervisor.Supervisor(rpc, lambda is_new_block: None)
+    registry = TemplateRegistry(BlockTemplate, stubs.StubCoinbaser(), rpc, settings.INSTANCE_ID,
+                                factory.on_template, recorder.on_network_block)
+    Interfaces.set_template_registry(registry)
+
+    directory = tempfile.mkdtemp()
+    results = []
+
+    def check(name, ok):
+        results.append(ok)
+        print "%-40s %s" % (name, 'OK' if ok else 'FAILED')
+
+    @defer.inlineCallbacks
+    def run():
+        yield wait_for(lambda: registry.last_block != None, args.timeout)
+        # Front-ends run this file as a script
+        os.environ['PYTHONPATH'] = os.pathsep.join([os.getcwd()] + sys.path)
+        factory.start(registry, os.path.join(directory, 'supervisor.sock'), args.frontends)
+        instance_ids = sorted(factory.processes.keys())
+
+        start = time.time()
+        ok = yield wait_for(lambda: all(recorder.count(i) >= args.shares for i in instance_ids), args.timeout)
+        check("Share records of %d front-ends" % len(instance_ids), ok)
+        print "    %d records in %.03f sec, %d valid" % (len(recorder.shares), time.time() - start,
+                                                          len([ s for s in recorder.shares if s[1] ]))
+
+        # Block notification of a front-end goes to the supervisor. Front-ends
+        # submit one share on the job of the new block (job ids are assigned
+        # by every registry on its own)
+        client = supervisor.SupervisorClient(factory.path)
+        yield client.connect()
+        counts = dict((i, recorder.count(i)) for i in instance_ids)
+        daemon.new_block(stubs.build_template(args.txs))
+        client.update_block()
+        ok = yield wait_for(lambda: all(recorder.count(i) > counts[i] for i in instance_ids), args.timeout)
+        check("New block pushed to front-ends", ok)
+
+        difficulty = yield client.getdifficulty()
+        try:
+            yield client._call('getblock', '00')
+            refused = False
+        except Exception:
+            refused = True
+        check("RPC whitelist", difficulty == 1.0 and refused)
+
+        instance_id = instance_ids[0]
+        (pid, before) = (factory.processes[instance_id].pid, recorder.count(instance_id))
+        os.kill(pid, signal.SIGKILL)
+        ok = yield wait_for(lambda: instance_id in factory.processes and factory.processes[instance_id].pid != pid and
+                            recorder.count(instance_id) >= before + args.shares, args.timeout)
+        check("Killed front-end restarted", ok)
+
+        factory.stop()
+        yield wait_for(lambda: not factory.processes, args.timeout)
+        reactor.stop()
+
+    def _failed(failure):
+        failure.printTraceback()
+        results.append(False)
+        factory.stop()
+        reactor.stop()
+
+    reactor.callWhenRunning(lambda: run().addErrback(_failed))
+    reactor.run()
+    shutil.rmtree(directory, ignore_errors=True)
+    return all(results) and len(results) == 4
+
+def run_frontend(args, frontend_id):
+    from twisted.internet import defer, reactor
+    import lib.settings as settings
+    from mining.interfaces import Interfaces
+    from mining.service import MiningService
+    from mining import supervisor
+    from lib.template_registry import TemplateRegistry
+    from lib.block_template import BlockTemplate
+
+    setup_interfaces()
+    client = supervisor.SupervisorClient(supervisor.get_supervisor_socket())
+    settings.INSTANCE_ID = frontend_id
+    Interfaces.set_share_manager(supervisor.FrontendShareManager(client))
+    connections = []
+
+    def on_template(is_new_block):
+        if not is_new_block or not connections:
+            return
+        # One share on the new job, its record tells the supervisor the template arrived
+        conn = connections[0]
+        registry = Interfaces.template_registry
+        job_id = registry.last_block.job_id
+        conn.get_session()['jobs'].add(job_id, args.difficulty)
+        service = MiningService()
+        service.connection_ref = weakref.ref(conn)
+        ntime = binascii.hexlify(struct.pack("<I", registry.last_block.curtime))
+        d = defer.maybeDeferred(service.submit, 'bench', job_id, '00' * registry.extranonce2_size, ntime, '00000000')
+        d.addErrback(lambda f: None)
+
+    @defer.inlineCallbacks
+    def run():
+        yield client.connect()
+        registry = TemplateRegistry(BlockTemplate, stubs.StubCoinbaser(), client, frontend_id,
+                                    on_template, lambda: None)
+        Interfaces.template_registry = registry
+        client.set_registry(registry)
+        yield wait_for(lambda: registry.last_block != None, args.timeout)
+        connections.extend(create_connections(registry, args.connections, args.difficulty, frontend_id))
+        bench = SubmitBench(registry, connections, args)
+        bench.generate()
+        elapsed = yield bench.run()
+        print "Front-end %d (pid %d): %d shares in %.03f sec" % (frontend_id, os.getpid(), args.shares, elapsed)
+
+    reactor.callWhenRunning(run)
+    reactor.run()
+
+def main():
+    parser = argparse.ArgumentParser(description='Check of supervisor with front-end processes.')
+    parser.add_argument('--frontends', type=int, default=2, help='front-end processes')
+    parser.add_argument('--shares', type=int, default=500, help='submits of every front-end')
+    parser.add_argument('--connections', type=int, default=10, help='simulated miner connections of every front-end')
+    parser.add_argument('--window', type=int, default=64, help='max. submits in flight')
+    parser.add_argument('--mix', default='90,4,3,3', help='ratio of valid,invalid,duplicate,stale shares')
+    parser.add_argument('--difficulty', type=float, default=0.00000001, help='share difficulty of the connections')
+    parser.add_argument('--txs', type=int, default=100, help='transactions in synthetic template')
+    parser.add_argument('--timeout', type=float, default=30, help='seconds to wait for every step')
+    parser.add_argument('--loglevel', default='WARNING')
+    # Added by Supervisor.spawn
+    parser.add_argument('--pidfile', default=None, help=argparse.SUPPRESS)
+    parser.add_argument('--nodaemon', action='store_true', help=argparse.SUPPRESS)
+    parser.add_argument('--logfile', default=None, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    stubs.setup_offline(args.loglevel)
+    from mining import supervisor
+
+    frontend_id = supervisor.get_frontend_id()
+    if frontend_id != None:
+        run_frontend(args, frontend_id)
+    elif not run_supervisor(args):
+        sys.exit(1)
+
+if __name__ == '__main__':
+    main()
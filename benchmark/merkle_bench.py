@@ -0,0 +1,63 @@
+'''Benchmark of merkle branch calculation on large templates.
+
+Simulates template refreshes of a busy mempool: every refresh keeps
+most transactions, drops a few mined ones and appends new ones at
+the tail. Compares MerkleTree with and without PairHashCache and
+checks that both give the same merkle branch.
+
+    python -m benchmark.merkle_bench --txs 5000 --refreshes 20
+'''
+
+import argparse
+import os
+import time
+
+from benchmark import stubs
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark of merkle tree with cached interior nodes.')
+    parser.add_argument('--txs', type=int, default=5000, help='transactions in the template')
+    parser.add_argument('--refreshes', type=int, default=20, help='template refreshes to simulate')
+    parser.add_argument('--added', type=int, default=50, help='new transactions per refresh')
+    parser.add_argument('--removed', type=int, default=0, help='transactions removed from the middle per refresh')
+    parser.add_argument('--cache-size', type=int, default=100000)
+    args = parser.parse_args()
+
+    stubs.setup_offline()
+    from lib import merkletree
+
+    cache = merkletree.PairHashCache(args.cache_size)
+    hashes = [ os.urandom(40) for _ in xrange(args.txs) ]
+    (plain_time, cached_time) = (0.0, 0.0)
+
+    for i in xrange(args.refreshes + 1):
+        start = time.time()
+        plain = merkletree.MerkleTree([None] + hashes)
+        plain_time += time.time() - start
+
+        (hits, misses) = (cache.hits, cache.misses)
+        start = time.time()
+        cached = merkletree.MerkleTree([None] + hashes, cache=cache)
+        cached_time += time.time() - start
+
+        if plain._steps != cached._steps:
+            raise Exception("Merkle branch differs on refresh %d" % i)
+
+        if i == 0:
+            print "Initial tree: %.03f ms plain, %.03f ms cached (%d hashes)" % (plain_time * 1000,
+                    cached_time * 1000, cache.misses - misses)
+            (plain_time, cached_time) = (0.0, 0.0)
+        else:
+            print "Refresh %3d: %6d txs, %6d hashes, %6d reused" % (i, len(hashes),
+                    cache.misses - misses, cache.hits - hits)
+
+        middle = len(hashes) // 2
+        hashes = hashes[:middle] + hashes[middle + args.removed:] + [ os.urandom(40) for _ in xrange(args.added) ]
+
+    if args.refreshes:
+        print
+        print "Average refresh: %.03f ms plain, %.03f ms cached, %.02fx" % (plain_time * 1000 / args.refreshes,
+                cached_time * 1000 / args.refreshes, plain_time / cached_time)
+
+if __name__ == '__main__':
+    main()
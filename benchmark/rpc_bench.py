@@ -0,0 +1,75 @@
+'''Benchmark of BitcoinRPC against the local stub daemon.
+
+Reports latency of the calls and how many of them reused
+a keep-alive connection.
+
+    python -m benchmark.rpc_bench --calls 2000 --method getwork --concurrency 2
+    python -m benchmark.rpc_bench --calls 500 --method prevhash --daemons 3
+'''
+
+import argparse
+import time
+
+from benchmark import stubs, stub_daemon
+from benchmark.submit_bench import percentile
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark of BitcoinRPC with stub coin daemon.')
+    parser.add_argument('--calls', type=int, default=2000)
+    parser.add_argument('--method', default='getwork', help='BitcoinRPC method without arguments')
+    parser.add_argument('--concurrency', type=int, default=1, help='calls in flight')
+    parser.add_argument('--pool-size', type=int, default=2, help='keep-alive connections to the daemon')
+    parser.add_argument('--txs', type=int, default=100, help='transactions in synthetic template')
+    parser.add_argument('--daemons', type=int, default=1, help='stub daemons, more than one uses DaemonGroup')
+    parser.add_argument('--delay', type=float, default=0, help='answer delay of the stub daemons')
+    parser.add_argument('--loglevel', default='WARNING')
+    args = parser.parse_args()
+
+    stubs.setup_offline(args.loglevel)
+
+    from twisted.internet import defer, reactor
+    from lib.bitcoin_rpc import BitcoinRPC
+    from lib.daemon_group import DaemonGroup
+
+    template = stubs.build_template(args.txs)
+    daemons = [ stub_daemon.listen(template, delay=args.delay) for _ in xrange(args.daemons) ]
+    rpcs = [ BitcoinRPC('127.0.0.1', port.getHost().port, 'user', 'pass', pool_size=args.pool_size)
+             for (_, port) in daemons ]
+    if len(rpcs) > 1:
+        rpc = DaemonGroup(rpcs)
+    else:
+        rpc = rpcs[0]
+    latencies = []
+    errors = []
+
+    @defer.inlineCallbacks
+    def worker(count):
+        for _ in xrange(count):
+            start = time.time()
+            try:
+                yield getattr(rpc, args.method)()
+            except Exception as e:
+                errors.append(str(e))
+            latencies.append(time.time() - start)
+
+    @defer.inlineCallbacks
+    def run():
+        start = time.time()
+        per_worker = args.calls // args.concurrency
+        yield defer.DeferredList([ worker(per_worker) for _ in xrange(args.concurrency) ])
+        elapsed = time.time() - start
+
+        values = sorted(latencies)
+        print "Calls: %d in %.03f sec, %.01f calls/sec, %d errors" % (len(values), elapsed, len(values) / elapsed, len(errors))
+        print "Latency ms: p50 %.03f p99 %.03f max %.03f" % (percentile(values, 0.5) * 1000,
+                                                            percentile(values, 0.99) * 1000, values[-1] * 1000)
+        print "Client: %s" % rpc.get_stats()
+        for (daemon, port) in daemons:
+            print "Daemon %d: %d connections, calls %s" % (port.getHost().port, len(daemon.connections), daemon.calls)
+        reactor.stop()
+
+    reactor.callWhenRunning(run)
+    reactor.run()
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,134 @@
+'''Local JSON-RPC server answering like a coin daemon.
+
+Serves a synthetic (or recorded) template over HTTP/1.1 keep-alive,
+so lib.bitcoin_rpc.BitcoinRPC can be tested without a real daemon.
+It can run standalone, e.g. to start the pool against it:
+
+    python -m benchmark.stub_daemon --port 19334 --txs 500
+'''
+
+import argparse
+import json
+
+from twisted.internet import defer, reactor, task
+from twisted.web import resource, server
+
+from benchmark import stubs
+from lib import util
+
+class StubDaemon(resource.Resource):
+    '''JSON-RPC resource implementing the calls used by the pool.
+
+    Every answer can be delayed by delay seconds, getblocktemplate
+    with current longpollid is held until new_block() is called.'''
+    isLeaf = True
+
+    def __init__(self, template, delay=0):
+        resource.Resource.__init__(self)
+        self.template = template
+        self.delay = delay
+        self.calls = {}
+        self.blocks = []
+        self.connections = set()
+        self.longpolls = []
+
+    def new_block(self, template):
+        self.template = template
+        (longpolls, self.longpolls) = (self.longpolls, [])
+        for d in longpolls:
+            d.callback(template)
+
+    def render_POST(self, request):
+        self.connections.add(request.transport)
+        body = json.loads(request.content.read())
+
+        if isinstance(body, list):
+            # Batch request is answered with 200 even if some calls failed
+            d = defer.gatherResults([ self._dispatch(call) for call in body ])
+            d.addCallback(lambda results: (200, [ response for (_, response) in results ]))
+        else:
+            d = self._dispatch(body)
+
+        if self.delay:
+            d.addCallback(lambda result: task.deferLater(reactor, self.delay, lambda: result))
+        d.addCallback(self._respond, request)
+        return server.NOT_DONE_YET
+
+    def _respond(self, result, request):
+        if request._disconnected:
+            # Client gave up, e.g. timed out long poll
+            return
+        (code, response) = result
+        request.setResponseCode(code)
+        request.setHeader('Content-Type', 'application/json')
+        request.write(json.dumps(response))
+        request.finish()
+
+    def _dispatch(self, call):
+        '''Returns Deferred firing with (HTTP code, response) of single JSON-RPC call'''
+        method = call['method']
+        self.calls[method] = self.calls.get(method, 0) + 1
+
+        func = getattr(self, 'rpc_%s' % method, None)
+        if func == None:
+            return defer.succeed((404, {'result': None, 'error': {'code': -32601, 'message': 'Method not found'}, 'id': call['id']}))
+
+        d = defer.maybeDeferred(func, *call['params'])
+        d.addCallbacks(lambda result: (200, {'result': result, 'error': None, 'id': call['id']}),
+                       lambda f: (500, {'result': None, 'error': {'code': -1, 'message': f.getErrorMessage()}, 'id': call['id']}))
+        return d
+
+    def rpc_getblocktemplate(self, params=None):
+        if params and params.get('longpollid') == self.template['longpollid']:
+            d = defer.Deferred()
+            self.longpolls.append(d)
+            return d
+        return self.template
+
+    def rpc_getwork(self, *params):
+        # Only prevhash (chars 16:96, byte-reversed) is used by the pool
+        return {'data': '00' * 8 + util.rev(self.template['previousblockhash']) + '00' * 80}
+
+    def rpc_submitblock(self, block_hex, txs=None):
+        self.blocks.append(block_hex)
+        return None
+
+    def rpc_validateaddress(self, address):
+        return {'isvalid': True, 'address': address, 'ismine': True, 'pubkey': '00' * 33}
+
+    def rpc_getinfo(self):
+        return {'blocks': self.template['height'] - 1, 'balance': 0.0, 'connections': 8, 'difficulty': 1.0}
+
+    def rpc_getdifficulty(self):
+        return 1.0
+
+    def rpc_getblock(self, block_hash_hex):
+        return {'hash': block_hash_hex}
+
+def listen(template, port=0, interface='127.0.0.1', delay=0):
+    '''Starts the stub daemon, returns (StubDaemon, listening port)'''
+    daemon = StubDaemon(template, delay)
+    return (daemon, reactor.listenTCP(port, server.Site(daemon), interface=interface))
+
+def main():
+    parser = argparse.ArgumentParser(description='Stub coin daemon JSON-RPC server.')
+    parser.add_argument('--port', type=int, default=19334)
+    parser.add_argument('--txs', type=int, default=100, help='transactions in synthetic template')
+    parser.add_argument('--template', default=None, help='recorded getblocktemplate JSON instead of synthetic one')
+    parser.add_argument('--delay', type=float, default=0, help='seconds to delay every answer')
+    parser.add_argument('--block-interval', type=float, default=0, help='seconds between synthetic new blocks')
+    args = parser.parse_args()
+
+    if args.template:
+        template = stubs.load_template(args.template)
+    else:
+        template = stubs.build_template(args.txs)
+
+    (daemon, _) = listen(template, args.port, delay=args.delay)
+    if args.block_interval:
+        task.LoopingCall(lambda: daemon.new_block(stubs.build_template(args.txs))).start(args.block_interval, now=False)
+    print "Stub daemon listening on 127.0.0.1:%d" % args.port
+    reactor.run()
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,142 @@
+'''Local replacements of the coin daemon, MySQL and miner connections.
+
+setup_offline() must be called before any pool module is imported,
+because mining.interfaces connects to the database on import.'''
+
+import binascii
+import imp
+import json
+import os
+import random
+import struct
+import sys
+import time
+
+class StubDB(object):
+    '''In-memory stand-in for mining.DB_Mysql.DB_Mysql'''
+    def __init__(self):
+        self.shares = 0
+        self.blocks = 0
+
+    def check_tables(self):
+        pass
+
+    def import_shares(self, data):
+        self.shares += len(data)
+
+    def found_block(self, data):
+        self.blocks += 1
+
+    def get_user(self, id_or_username):
+        return (1, id_or_username)
+
+    def check_password(self, username, password):
+        return True
+
+    def insert_user(self, username, password):
+        return username
+
+    def update_worker_diff(self, username, diff):
+        pass
+
+    def clear_worker_diff(self):
+        pass
+
+    def close(self):
+        pass
+
+def setup_offline(loglevel='WARNING'):
+    '''Replaces MySQL backend by StubDB and silences logging'''
+    import lib.settings as settings
+    settings.LOGLEVEL = loglevel
+    settings.LOGFILE = None
+
+    module = imp.new_module('mining.DB_Mysql')
+    module.DB_Mysql = StubDB
+    sys.modules['mining.DB_Mysql'] = module
+
+def build_transaction(i):
+    '''Serialized transaction spending made-up outpoint i'''
+    r = struct.pack("<i", 2)
+    r += chr(1) + struct.pack("<I", i) * 10 + struct.pack("<I", 0)
+    r += chr(25) + os.urandom(25) + struct.pack("<I", 0xffffffff)
+    r += chr(2)
+    for _ in xrange(2):
+        r += struct.pack("<q", random.randint(1, 10 ** 8)) + chr(25) + os.urandom(25)
+    r += struct.pack("<QQQ", int(time.time()) * 1000, 0, 0)
+    return r
+
+def build_template(tx_count=100, block_target='0000000000ffff' + '0' * 66):
+    '''Synthetic getblocktemplate result'''
+    import kshake320_hash
+
+    transactions = []
+    for i in xrange(tx_count):
+        tx = build_transaction(i)
+        transactions.append({
+            'data': binascii.hexlify(tx),
+            'hash': binascii.hexlify(kshake320_hash.getHash320(tx)[::-1]),
+        })
+
+    return {
+        'height': 100000,
+        'version': 2,
+        'previousblockhash': binascii.hexlify(os.urandom(40)),
+        'bits': '1d00ffff',
+        'target': block_target,
+        'transactions': transactions,
+        'coinbasevalue': 5000000000,
+        'coinbaseaux': {'flags': '062f503253482f'},
+        'curtime': int(time.time()),
+        'longpollid': binascii.hexlify(os.urandom(8)),
+    }
+
+def load_template(filename):
+    '''Loads recorded getblocktemplate result (with or without JSON-RPC envelope)'''
+    with open(filename) as f:
+        data = json.load(f)
+    return data.get('result', data)
+
+class StubBitcoinRPC(object):
+    '''Serves the same template forever and accepts every block'''
+    def __init__(self, template):
+        self.template = template
+        self.submitted = []
+
+    def getblocktemplate(self, *args, **kwargs):
+        from twisted.internet import defer
+        return defer.succeed(self.template)
+
+    def submitblock_wtxs(self, block_hex, txs, block_hash_hex):
+        from twisted.internet import defer
+        self.submitted.append(block_hash_hex)
+        return defer.succeed(True)
+
+class StubCoinbaser(object):
+    def __init__(self):
+        self.on_load = None
+
+    def get_script_pubkey(self):
+        return '\x76\xa9\x14' + '\x00' * 20 + '\x88\xac'
+
+    def get_coinbase_data(self):
+        return ''
+
+class StubConnection(object):
+    '''Just enough of stratum.protocol.Protocol for MiningService'''
+    def __init__(self, ip='127.0.0.1'):
+        self.session = {}
+        self.ip = ip
+        self.written = 0
+
+    def get_session(self):
+        return self.session
+
+    def _get_ip(self):
+        return self.ip
+
+    def rpc(self, method, params, is_notification=False):
+        self.written += 1
+
+    def transport_write(self, data):
+        self.written += 1
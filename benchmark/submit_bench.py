@@ -0,0 +1,227 @@
+'''End-to-end benchmark of mining.submit.
+
+Drives valid, invalid, duplicate and stale shares through
+MiningService.submit -> TemplateRegistry.submit_share ->
+ShareManagerInterface.on_submit_share with a real BlockTemplate
+and reports throughput and latency percentiles.
+
+    python -m benchmark.submit_bench --shares 50000 --connections 200 \
+        --mix 90,4,3,3 --difficulty 0.0001 --hashing process
+'''
+
+import argparse
+import binascii
+import struct
+import sys
+import time
+import weakref
+
+from benchmark import stubs
+
+def percentile(values, p):
+    '''values must be sorted'''
+    if not values:
+        return 0.0
+    return values[min(len(values) - 1, int(len(values) * p))]
+
+class SubmitBench(object):
+    def __init__(self, registry, connections, args):
+        self.registry = registry
+        self.connections = connections
+        self.args = args
+        self.shares = []
+        self.sent = 0
+        self.pending = 0
+        self.filling = False
+        self.latencies = {}
+        self.outcomes = {}
+        self.start = None
+        self.on_finish = None
+
+    def generate(self):
+        '''Prepares the shares up-front, so generating them is not measured'''
+        args = self.args
+        (valid, invalid, duplicate, stale) = [ int(x) for x in args.mix.split(',') ]
+        kinds = ['valid'] * valid + ['invalid'] * invalid + ['duplicate'] * duplicate + ['stale'] * stale
+
+        job_id = self.registry.last_block.job_id
+        ntime = binascii.hexlify(struct.pack("<I", self.registry.last_block.curtime))
+        extranonce2_fmt = "%%0%dx" % (self.registry.extranonce2_size * 2)
+        (valid_conns, hard_conn) = (self.connections[:-1], self.connections[-1])
+
+        done = []
+        for i in xrange(args.shares):
+            kind = kinds[i % len(kinds)]
+            conn = valid_conns[i % len(valid_conns)]
+            nonce = "%08x" % (i // len(valid_conns))
+            extranonce2 = extranonce2_fmt % 0
+
+            if kind == 'valid':
+                share = (conn, ('bench', job_id, extranonce2, ntime, nonce))
+                done.append(share)
+            elif kind == 'invalid':
+                # Connection with impossible difficulty, so the share is fully hashed and rejected
+                share = (hard_conn, ('bench', job_id, extranonce2, ntime, "%08x" % i))
+            elif kind == 'duplicate' and done:
+                share = done[i % len(done)]
+            else:
+                kind = 'stale'
+                share = (conn, ('bench', 'deadbeef', extranonce2, ntime, nonce))
+
+            self.shares.append((kind, share[0], share[1]))
+
+    def run(self):
+        from twisted.internet import defer
+        self.on_finish = defer.Deferred()
+        self.start = time.time()
+        self._fill()
+        return self.on_finish
+
+    def _fill(self):
+        if self.filling:
+            # Results of inline hashing fire synchronously, loop below continues
+            return
+
+        self.filling = True
+        while self.pending < self.args.window and self.sent < len(self.shares):
+            (kind, conn, params) = self.shares[self.sent]
+            self.sent += 1
+            self.pending += 1
+            self._submit(kind, conn, params)
+        self.filling = False
+
+        if not self.pending and self.sent == len(self.shares) and not self.on_finish.called:
+            self.on_finish.callback(time.time() - self.start)
+
+    def _submit(self, kind, conn, params):
+        from twisted.internet import defer
+        from mining.service import MiningService
+
+        service = MiningService()
+        service.connection_ref = weakref.ref(conn)
+        start = time.time()
+        d = defer.maybeDeferred(service.submit, *params)
+        d.addBoth(self._done, kind, start)
+
+    def _done(self, result, kind, start):
+        self.latencies.setdefault(kind, []).append(time.time() - start)
+
+        if result is True:
+            outcome = 'accepted'
+        else:
+            outcome = result.getErrorMessage()
+        key = (kind, outcome)
+        self.outcomes[key] = self.outcomes.get(key, 0) + 1
+
+        self.pending -= 1
+        self._fill()
+
+    def report(self, elapsed):
+        total = len(self.shares)
+        print "Shares: %d in %.03f sec, %.01f submits/sec" % (total, elapsed, total / elapsed)
+        print
+        print "%-10s %8s %10s %10s %10s %10s" % ('kind', 'count', 'p50 ms', 'p99 ms', 'p999 ms', 'max ms')
+
+        everything = []
+        for kind in ('valid', 'invalid', 'duplicate', 'stale'):
+            values = sorted(self.latencies.get(kind, []))
+            everything.extend(values)
+            self._report_line(kind, values)
+        self._report_line('all', sorted(everything))
+
+        print
+        for ((kind, outcome), count) in sorted(self.outcomes.items()):
+            print "%-10s %8d  %s" % (kind, count, outcome)
+
+    def _report_line(self, kind, values):
+        if not values:
+            return
+        print "%-10s %8d %10.03f %10.03f %10.03f %10.03f" % (kind, len(values),
+            percentile(values, 0.5) * 1000, percentile(values, 0.99) * 1000,
+            percentile(values, 0.999) * 1000, values[-1] * 1000)
+
+def create_connections(registry, count, difficulty, network=0):
+    '''Subscribed and authorized connections for SubmitBench,
+    plus the last one with impossible difficulty for 'invalid' shares'''
+    import lib.settings as settings
+    from mining.service import MiningService
+    from mining.job_ring import JobRing
+
+    connections = []
+    for i in xrange(count + 1):
+        conn = stubs.StubConnection('10.%d.%d.%d' % (network, i // 250, i % 250))
+        service = MiningService()
+        service.connection_ref = weakref.ref(conn)
+        session = conn.get_session()
+        session['extranonce1'] = registry.get_new_extranonce1()
+        session['difficulty'] = difficulty if i < count else 2 ** 64
+        session['jobs'] = JobRing(settings.JOB_RING_SIZE)
+        session['jobs'].add(registry.last_block.job_id, session['difficulty'])
+        service.authorize('bench', 'x')
+        connections.append(conn)
+    return connections
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark of mining.submit path with stub coin daemon.')
+    parser.add_argument('--shares', type=int, default=20000, help='number of submits')
+    parser.add_argument('--connections', type=int, default=100, help='number of simulated miner connections')
+    parser.add_argument('--window', type=int, default=256, help='max. submits in flight')
+    parser.add_argument('--mix', default='90,4,3,3', help='ratio of valid,invalid,duplicate,stale shares')
+    parser.add_argument('--difficulty', type=float, default=0.00000001, help='share difficulty of the connections')
+    parser.add_argument('--txs', type=int, default=500, help='transactions in synthetic template')
+    parser.add_argument('--template', default=None, help='recorded getblocktemplate JSON instead of synthetic one')
+    parser.add_argument('--hashing', default='process', help='share hashing mode: process, thread or inline')
+    parser.add_argument('--workers', type=int, default=0, help='share hashing workers, 0 = CPU count')
+    parser.add_argument('--vardiff', action='store_true', help='use BasicShareLimiter')
+    parser.add_argument('--loglevel', default='WARNING')
+    args = parser.parse_args()
+
+    stubs.setup_offline(args.loglevel)
+
+    from twisted.internet import reactor
+    import lib.settings as settings
+    from mining.interfaces import Interfaces, WorkerManagerInterface, ShareManagerInterface, \
+                                  ShareLimiterInterface, TimestamperInterface
+    from lib.template_registry import TemplateRegistry
+    from lib.block_template import BlockTemplate
+    from lib.share_hasher import ShareHasher
+
+    # Fork hashing workers before anything else happens
+    share_hasher = ShareHasher(args.hashing, args.workers)
+
+    Interfaces.set_timestamper(TimestamperInterface())
+    Interfaces.set_worker_manager(WorkerManagerInterface())
+    Interfaces.set_share_manager(ShareManagerInterface())
+    if args.vardiff:
+        from mining.basic_share_limiter import BasicShareLimiter
+        Interfaces.set_share_limiter(BasicShareLimiter())
+    else:
+        Interfaces.set_share_limiter(ShareLimiterInterface())
+
+    if args.template:
+        template = stubs.load_template(args.template)
+    else:
+        template = stubs.build_template(args.txs)
+
+    # Shares are generated from the first template before the reactor runs
+    settings.TEMPLATE_BUILD_IN_THREAD = False
+    registry = TemplateRegistry(BlockTemplate, stubs.StubCoinbaser(), stubs.StubBitcoinRPC(template),
+                                settings.INSTANCE_ID, lambda is_new_block: None, lambda: None, share_hasher)
+    Interfaces.set_template_registry(registry)
+
+    connections = create_connections(registry, args.connections, args.difficulty)
+    bench = SubmitBench(registry, connections, args)
+    bench.generate()
+
+    def _finish(elapsed):
+        bench.report(elapsed)
+        reactor.stop()
+
+    def _start():
+        bench.run().addCallback(_finish)
+
+    reactor.callWhenRunning(_start)
+    reactor.run()
+
+if __name__ == '__main__':
+    main()
@@ -12,6 +12,15 @@ DAEMON_TRUSTED_PORT = 19334
 DAEMON_TRUSTED_USER = 'user'
 DAEMON_TRUSTED_PASSWORD = 'pass'
 
+# More daemons to detect new blocks earlier and broadcast found blocks from more nodes,
+# the pool uses the one which reports new block first, e.g. [('10.0.0.2', 19334, 'user', 'pass')]
+DAEMON_TRUSTED_EXTRA = []
+
+DAEMON_RPC_POOL_SIZE = 2        # Keep-alive HTTP connections kept open to the daemon
+DAEMON_RPC_TIMEOUT = 30         # Seconds before a daemon RPC call is given up
+DAEMON_RPC_IDLE_TIMEOUT = 20    # Seconds an idle connection is kept open, keep it below
+                                # the daemon's own limit (-rpcservertimeout)
+
 # ******************** GENERAL SETTINGS ***************
 # Set process name of twistd, much more comfortable if you run multiple processes on one machine
 STRATUM_MINING_PROCESS_NAME= 'stratum_server'
@@ -58,6 +67,11 @@ LISTEN_WSS_TRANSPORT = None
 # Salt used for Block Notify Password
 PASSWORD_SALT = 'some_crazy_string'
 
+# Local endpoint for -blocknotify, see lib/block_notify.py. Loopback UDP port
+# (e.g. 3334) or path of unix datagram socket, 'None' for disabling it
+BLOCKNOTIFY_LISTEN = None
+BLOCKNOTIFY_SECRET = ''         # First word of every notification, must be set
+
 # ******************** Database  *********************
 # MySQL
 DB_MYSQL_HOST = 'localhost'
@@ -94,12 +108,43 @@ PREVHASH_REFRESH_INTERVAL = 5   # How often to check for new Blocks
 MERKLE_REFRESH_INTERVAL = 60    # How often check memorypool
                                 # This effectively resets the template and incorporates new transactions.
                                 # This should be "slow"
-
-INSTANCE_ID = 31                # Used for extranonce and needs to be 0-31
+MERKLE_CACHE_SIZE = 100000      # Interior merkle tree hashes remembered between template refreshes,
+                                # should be about 2x number of transactions in a template
+TEMPLATE_BUILD_IN_THREAD = True # Decode getblocktemplate and build templates out of the reactor thread
+GBT_LONGPOLL = True             # Keep getblocktemplate long poll request outstanding, daemon answers it
+                                # on new block. Falls back to polling if the daemon doesn't support it.
+LONGPOLL_TIMEOUT = 600          # Seconds before the outstanding long poll request is restarted
+LONGPOLL_WATCHDOG_INTERVAL = 30 # Prevhash polling interval while long polling works
+
+INSTANCE_ID = 31                # Used for extranonce and needs to be 0 - 2**EXTRANONCE_INSTANCE_BITS-1
+EXTRANONCE_INSTANCE_BITS = 5    # Bits of extranonce1 taken by instance id, the rest counts connections of the instance
+EXTRANONCE_QUARANTINE = 900     # Seconds before extranonce1 of closed connection is reused, keep it above
+                                # WORKER_CACHE_TIME + WORKER_BAN_TIME so stats of the old connection expire first
+FRONTEND_PROCESSES = 0          # Stratum front-end processes sharing LISTEN_SOCKET_TRANSPORT, 0 = single process.
+                                # This process becomes the supervisor: it talks to the coin daemon and records
+                                # shares, front-ends get instance ids other than INSTANCE_ID.
+SUPERVISOR_SOCKET = 'run/supervisor.sock' # Unix socket between supervisor and front-ends, mode 0600,
+                                # its directory is created with mode 0700
+FRONTEND_SHARE_HASHING_MODE = 'inline' # SHARE_HASHING_MODE of front-ends, the processes already use the cores
 
 FORCE_REFRESH_INTERVAL = 300    # How often to 'force' new work if no new blocks 
 
-WORK_EXPIRE = 180               # How long before work expires
+JOB_RING_SIZE = 16              # Jobs remembered per connection with their difficulty, older submits
+                                # are checked against the current difficulty
+BROADCAST_TIME_SLICE = 0.01     # Seconds a job broadcast may run before other events get a turn,
+                                # 0 notifies all miners at once
+BROADCAST_HIGH_DIFF_FIRST = True # Notify highest difficulty miners first, they switch most hashrate
+SLOW_CONSUMER_BUFFER = 65536    # Bytes of unsent output after which a connection only gets the latest job
+SLOW_CONSUMER_TIMEOUT = 60      # Seconds a connection may stay above SLOW_CONSUMER_BUFFER before it is disconnected
+
+# ******************** Share Processing Settings *********************
+SHARE_HASHING_MODE = 'inline'   # Where shares are hashed: 'inline' (on the reactor thread), 'thread'
+                                # or 'process' (opt-in, forks SHARE_HASHING_WORKERS processes, scales with CPU cores)
+SHARE_HASHING_WORKERS = 0       # Number of hashing workers, 0 = number of CPU cores
+DUPLICATE_CHECK_MAX_SHARES = 100000 # Max. shares of one connection remembered per job for duplicate
+                                # detection. Once reached, further shares of that connection on the job,
+                                # even valid unique ones, are rejected with "Too many shares for this job"
+                                # until it gets a new job. Other connections are not affected.
 
 # ******************** Pool Difficulty Settings *********************
 VDIFF_X2_TYPE = True           # Powers of 2 e.g. 2,4,8,16,32,64,128,256,512,1024
@@ -4,41 +4,153 @@
 
 import simplejson as json
 import base64
-from twisted.internet import defer
-from twisted.web import client
+import StringIO
+from twisted.internet import defer, reactor
+from twisted.web import client, error
+from twisted.web.http_headers import Headers
+from twisted.python import failure
 import time
 
+from lib.exceptions import RPCError
+
 import lib.logger
 log = lib.logger.get_logger('bitcoin_rpc')
 
+class RPCConnectionPool(client.HTTPConnectionPool):
+    '''Keep-alive connections to the coin daemon, counting
+    how many requests reused an already open connection'''
+
+    def __init__(self, reactor, size, idle_timeout):
+        client.HTTPConnectionPool.__init__(self, reactor, persistent=True)
+        self.maxPersistentPerHost = size
+        self.cachedConnectionTimeout = idle_timeout
+        self.retryAutomatically = False
+        self._factory.noisy = False
+        self.requests = 0
+        self.connections = 0
+
+    def getConnection(self, key, endpoint):
+        self.requests += 1
+        return client.HTTPConnectionPool.getConnection(self, key, endpoint)
+
+    def _newConnection(self, key, endpoint):
+        self.connections += 1
+        return client.HTTPConnectionPool._newConnection(self, key, endpoint)
+
 class BitcoinRPC(object):
     
-    def __init__(self, host, port, username, password):
+    def __init__(self, host, port, username, password, pool_size=2, timeout=30, idle_timeout=20):
         self.bitcoin_url = 'http://%s:%d' % (host, port)
         self.credentials = base64.b64encode("%s:%s" % (username, password))
-        self.headers = {
-            'Content-Type': 'text/json',
-            'Authorization': 'Basic %s' % self.credentials,
-        }
-        client.HTTPClientFactory.noisy = False
+        self.headers = Headers({
+            'Content-Type': ['text/json'],
+            'Authorization': ['Basic %s' % self.credentials],
+        })
+        self.timeout = timeout
+        self.pool = RPCConnectionPool(reactor, pool_size, idle_timeout)
+        self.agent = client.Agent(reactor, pool=self.pool)
+        self.calls = 0
+        self.failures = 0
+        self.timeouts = 0
+        self.retries = 0
 	self.has_submitblock = False        
 
-    def _call_raw(self, data):
-        client.Headers
-        return client.getPage(
-            url=self.bitcoin_url,
-            method='POST',
-            headers=self.headers,
-            postdata=data,
-        )
+    def get_stats(self):
+        '''Counters of RPC calls and connection reuse'''
+        return {
+            'calls': self.calls,
+            'failures': self.failures,
+            'timeouts': self.timeouts,
+            'retries': self.retries,
+            'requests': self.pool.requests,
+            'connections': self.pool.connections,
+            'reused': self.pool.requests - self.pool.connections,
+        }
+
+    def _call_raw(self, data, timeout=None):
+        self.calls += 1
+        d = self._request(data)
+        timer = reactor.callLater(timeout or self.timeout, d.cancel)
+        d.addErrback(self._retry_closed, data, timer)
+        d.addBoth(self._call_done, timer)
+        return d
+
+    def _request(self, data):
+        d = self.agent.request('POST', self.bitcoin_url, self.headers,
+                               client.FileBodyProducer(StringIO.StringIO(data)))
+        d.addCallback(self._read_response)
+        return d
+
+    def _read_response(self, response):
+        d = client.readBody(response)
+        if response.code != 200:
+            # Same error as getPage raised, callers check for "500 Internal Server Error"
+            d.addCallback(self._http_error, response)
+        return d
+
+    def _http_error(self, body, response):
+        raise error.Error(str(response.code), response.phrase, body)
+
+    def _retry_closed(self, f, data, timer):
+        # Daemon may close idle keep-alive connection right when it is reused,
+        # so the request is sent once more over a new connection.
+        f.trap(client.RequestNotSent, client.RequestTransmissionFailed, client.ResponseNeverReceived)
+        if not timer.active():
+            return f
+        self.retries += 1
+        return self._request(data)
+
+    def _call_done(self, result, timer):
+        if timer.active():
+            timer.cancel()
+        elif isinstance(result, failure.Failure):
+            self.timeouts += 1
+            result = failure.Failure(defer.TimeoutError("RPC call timed out"))
+
+        if isinstance(result, failure.Failure):
+            self.failures += 1
+        return result
            
-    def _call(self, method, params):
+    def _call(self, method, params, timeout=None):
         return self._call_raw(json.dumps({
                 'jsonrpc': '2.0',
                 'method': method,
                 'params': params,
                 'id': '1',
-            }))
+            }), timeout)
+
+    def batch(self, calls):
+        '''Sends list of (method, params) in single JSON-RPC request,
+        returns list of Deferreds firing with result of each call'''
+        ds = [ defer.Deferred() for _ in calls ]
+        d = self._call_raw(json.dumps([ {
+                'jsonrpc': '2.0',
+                'method': method,
+                'params': params,
+                'id': i,
+            } for (i, (method, params)) in enumerate(calls) ]))
+        d.addCallbacks(self._batch_done, self._batch_failed, callbackArgs=(ds,), errbackArgs=(ds,))
+        return ds
+
+    def _batch_done(self, resp, ds):
+        try:
+            responses = dict((r['id'], r) for r in json.loads(resp))
+        except Exception:
+            log.exception("Cannot decode batch response")
+            return self._batch_failed(failure.Failure(), ds)
+
+        for (i, d) in enumerate(ds):
+            r = responses.get(i)
+            if r == None:
+                d.errback(RPCError("No response to call %d of batch" % i))
+            elif r.get('error'):
+                d.errback(RPCError(r['error']))
+            else:
+                d.callback(r['result'])
+
+    def _batch_failed(self, f, ds):
+        for d in ds:
+            d.errback(f)
 
     @defer.inlineCallbacks
     def submitblock(self, block_hex, block_hash_hex):
@@ -89,17 +201,28 @@ class BitcoinRPC(object):
          defer.returnValue(json.loads(resp)['result'])
     
     @defer.inlineCallbacks
-    def getblocktemplate(self):
+    def getblocktemplate(self, raw=False):
+        '''With raw=True returns the JSON response undecoded,
+        so the caller can decode it out of the reactor thread'''
         try:
             resp = (yield self._call('getblocktemplate', [{}]))
-            defer.returnValue(json.loads(resp)['result'])
         except Exception as e:
             if (str(e) == "500 Internal Server Error"):
                 resp = (yield self._call('getblocktemplate', []))
-                defer.returnValue(json.loads(resp)['result'])
             else:
                 raise
 
+        if raw:
+            defer.returnValue(resp)
+        defer.returnValue(json.loads(resp)['result'])
+
+    @defer.inlineCallbacks
+    def getblocktemplate_longpoll(self, longpollid, timeout):
+        '''Daemon answers once the template identified
+        by longpollid is outdated (new block or transactions)'''
+        resp = (yield self._call('getblocktemplate', [{'longpollid': longpollid}], timeout))
+        defer.returnValue(json.loads(resp)['result'])
+
     @defer.inlineCallbacks
     def getwork(self):
         resp = (yield self._call('getwork', []))
@@ -118,6 +241,23 @@ class BitcoinRPC(object):
             log.exception("Cannot decode prevhash %s" % str(e))
             raise
         
+    @defer.inlineCallbacks
+    def prevhash_and_template(self):
+        '''Fetches prevhash and block template in single round trip.
+        Template is None when the daemon refused getblocktemplate.'''
+        (work, template) = self.batch([('getwork', []), ('getblocktemplate', [{}])])
+        template.addErrback(self._template_failed)
+        try:
+            prevhash = (yield work)['data'][16:96]
+        except Exception as e:
+            log.exception("Cannot decode prevhash %s" % str(e))
+            raise
+        defer.returnValue((prevhash, (yield template)))
+
+    def _template_failed(self, f):
+        log.info("Batched getblocktemplate failed: %s" % f.getErrorMessage())
+        return None
+
     @defer.inlineCallbacks
     def validateaddress(self, address):
         resp = (yield self._call('validateaddress', [address,]))
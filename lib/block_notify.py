@@ -0,0 +1,97 @@
+'''Local endpoint for -blocknotify of the coin daemon.
+
+Coin daemon notifies the pool by a single datagram instead of
+running scripts/blocknotify.sh, e.g. with bash 5 (%s is the block hash):
+
+    -blocknotify="bash -c 'echo secret %s $EPOCHREALTIME > /dev/udp/127.0.0.1/3334'"
+    -blocknotify="sh -c 'echo secret %s | socat - UNIX-SENDTO:/tmp/stratum-blocknotify.sock'"
+
+Datagram is "<secret> [<block hash> [<unix time of sending>]]",
+the optional time is used to measure notify latency.'''
+
+import hmac
+import os
+import time
+
+from twisted.internet import protocol
+
+import lib.logger
+log = lib.logger.get_logger('block_notify')
+
+class BlockNotifyListener(protocol.DatagramProtocol):
+    '''Triggers TemplateRegistry.update_block on authenticated datagram
+    and keeps timestamps of the last notification'''
+
+    def __init__(self, registry, secret):
+        self.registry = registry
+        self.secret = str(secret)
+        self.count = 0
+        self.rejected = 0
+        self.last_block_hash = None
+        self.last_sent = None # time of sending, as told by the sender
+        self.last_received = None
+        self.last_template = None # when the notification produced new template
+
+    def datagramReceived(self, data, addr):
+        received = time.time()
+        parts = data.split()
+
+        # Constant time, the sender can't guess the secret byte by byte
+        if not parts or not hmac.compare_digest(parts[0], self.secret):
+            self.rejected += 1
+            log.warning("Block notify with wrong secret from %s" % (addr,))
+            return
+
+        self.count += 1
+        self.last_received = received
+        self.last_block_hash = parts[1] if len(parts) > 1 else None
+        try:
+            self.last_sent = float(parts[2])
+            delay = " (%.03f sec after sending)" % (received - self.last_sent)
+        except (IndexError, ValueError):
+            self.last_sent = None
+            delay = ""
+
+        log.info("NEW BLOCK NOTIFICATION RECEIVED! %s%s" % (self.last_block_hash or '', delay))
+        d = self.registry.update_block()
+        if d:
+            d.addCallback(self._template_ready, received)
+
+    def _template_ready(self, result, received):
+        if result == None:
+            # Update failed, it has been logged by the registry
+            return
+        self.last_template = time.time()
+        log.info("Template for notified block ready in %.03f sec" % (self.last_template - received))
+        return result
+
+    def get_stats(self):
+        return {
+            'count': self.count,
+            'rejected': self.rejected,
+            'last_block_hash': self.last_block_hash,
+            'last_sent': self.last_sent,
+            'last_received': self.last_received,
+            'last_template': self.last_template,
+        }
+
+def listen(registry, secret, address):
+    '''Starts block notify listener, address is loopback UDP port
+    or path of unix datagram socket'''
+    from twisted.internet import reactor
+
+    if not secret:
+        log.error("BLOCKNOTIFY_SECRET is not set, block notify listener disabled")
+        return None
+
+    listener = BlockNotifyListener(registry, secret)
+    if isinstance(address, int):
+        reactor.listenUDP(address, listener, interface='127.0.0.1')
+        log.info("Block notify listening on udp 127.0.0.1:%d" % address)
+    else:
+        if os.path.exists(address):
+            # Left over by previous run
+            os.unlink(address)
+        reactor.listenUNIXDatagram(address, listener)
+        log.info("Block notify listening on %s" % address)
+    return listener
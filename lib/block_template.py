@@ -1,11 +1,14 @@
-import StringIO
 import binascii
+import json
 import struct
+import time
 
 import util
 import merkletree
 import halfnode
 from coinbasetx import CoinbaseTransaction
+from duplicate_detector import DuplicateDetector
+from tx_cache import TxCache
 import lib.logger
 log = lib.logger.get_logger('block_template')
 
@@ -18,23 +21,35 @@ class BlockTemplate(halfnode.CBlock):
     
     coinbase_transaction_class = CoinbaseTransaction
     
-    def __init__(self, timestamper, coinbaser, job_id):
+    def __init__(self, timestamper, coinbaser, job_id, tx_cache=None, merkle_cache=None):
         super(BlockTemplate, self).__init__()
         
         self.job_id = job_id 
         self.timestamper = timestamper
         self.coinbaser = coinbaser
+        self.tx_cache = tx_cache or TxCache() # transactions shared with other templates
+        self.merkle_cache = merkle_cache # interior merkle nodes shared with other templates
         
         self.prevhash_bin = '' # reversed binary form of prevhash
         self.prevhash_hex = ''
         self.timedelta = 0
         self.curtime = 0
         self.target = 0
+        self.target_bin = '' # big-endian binary form of target
         self.merkletree = None
+        self.coinbase = None
+        self.txs = [] # non-coinbase transactions (CachedTx), deserialized only when vtx is used
+        self.tx_count = 0 # including coinbase
+        self.longpollid = None
+        self.merkle_time = 0 # seconds spent building the merkle tree
         self.blank_hash = '00000000000000000000000000000000000000000000000000000000000000000000000000000000'
                 
+        self.header_head = '' # packed header fields before merkle root
+        self.header_mid = '' # packed header fields between merkle root and ntime
+                
         self.broadcast_args = []
-        self.submits = [] 
+        self.notify_tails = ('', '') # pre-encoded mining.notify after job id, see serialize_notify
+        self.submits = DuplicateDetector(settings.DUPLICATE_CHECK_MAX_SHARES)
                 
     def fill_from_rpc(self, data):
         '''Convert getblocktemplate result into BlockTemplate instance'''
@@ -42,10 +57,13 @@ class BlockTemplate(halfnode.CBlock):
             log.info("Waiting for new work...")
             self.prevhash_hex = self.blank_hash 
             self.broadcast_args = self.build_fake_broadcast_args()
+            self.notify_tails = self.build_notify_tails()
             return
 
-        txhashes = [None] + [ util.ser_uint320(int(t['hash'], 16)) for t in data['transactions'] ]
-        mt = merkletree.MerkleTree(txhashes)
+        txs = self.tx_cache.update(data['transactions'])
+        start = time.time()
+        mt = merkletree.MerkleTree([None] + [ tx.hash_bin for tx in txs ], cache=self.merkle_cache)
+        self.merkle_time = time.time() - start
 
         self.height = data['height']
         self.nVersion = data['version']
@@ -61,19 +79,21 @@ class BlockTemplate(halfnode.CBlock):
         self.nHashCoin = 0 
         self.sigchecksum = 0
 
-        coinbase = CoinbaseTransaction(self.timestamper, self.coinbaser, data['coinbasevalue'], data['coinbaseaux']['flags'], 
+        self.coinbase = CoinbaseTransaction(self.timestamper, self.coinbaser, data['coinbasevalue'], data['coinbaseaux']['flags'], 
             data['height'], settings.COINBASE_EXTRAS, self.cbTxTime)
 
-        self.vtx = [ coinbase, ]
-        for tx in data['transactions']:
-            t = halfnode.CTransaction()
-            t.deserialize(StringIO.StringIO(binascii.unhexlify(tx['data'])))
-            self.vtx.append(t)
+        self.txs = txs
+        self.vtx = None
+
+        # Block submission only needs to serialize the coinbase
+        self.tx_count = len(txs) + 1
             
         self.curtime = data['curtime']
+        self.longpollid = data.get('longpollid')
         self.timedelta = self.curtime - int(self.timestamper.time()) 
         self.merkletree = mt
         self.target = int((data['target']), 16)
+        self.target_bin = binascii.unhexlify("%080x" % self.target)
         log.info("Block height: %i network difficulty: %s" % (self.height, self.diff_to_t(self.target)))
 
         # Reversed prevhash
@@ -81,20 +101,34 @@ class BlockTemplate(halfnode.CBlock):
         self.prevhash_bin = binascii.unhexlify(util.rev(data['previousblockhash']))
         self.prevhash_hex = "%080x" % self.hashPrevBlock
         #log.info("%s\n", repr(self))
+
+        # Header fields which are the same for every share of this job,
+        # so serialize_header only appends merkle root, ntime and nonce
+        self.header_head = struct.pack("<ii", self.nVersion, self.nRegion) + self.prevhash_bin
+        self.header_mid = struct.pack("<QQII", self.nTxTime, self.nHashCoin, self.sigchecksum, self.nBits)
         
         self.broadcast_args = self.build_broadcast_args()
+        self.notify_tails = self.build_notify_tails()
+
+    def _get_vtx(self):
+        if self._vtx == None:
+            self._vtx = [ self.coinbase, ] + [ tx.tx for tx in self.txs ]
+        return self._vtx
+
+    def _set_vtx(self, vtx):
+        self._vtx = vtx
+
+    # Transactions are deserialized on first access, only block validation needs them
+    vtx = property(_get_vtx, _set_vtx)
 
     def diff_to_t(self, difficulty):
         '''Converts difficulty to target'''
         diff1 = 0x000000ffff000000000000000000000000000000000000000000000000000000000000000000000
         return float(diff1 * 16) / float(difficulty)
                 
-    def register_submit(self, extranonce1, extranonce2, ntime, nonce):
-        t = (extranonce1, extranonce2, ntime, nonce)
-        if t not in self.submits:
-            self.submits.append(t)
-            return True
-        return False
+    def register_submit(self, extranonce1_bin, extranonce2_bin, ntime_bin, nonce_bin):
+        '''Returns False if the same submit has been already registered'''
+        return self.submits.register(extranonce1_bin, extranonce2_bin, ntime_bin, nonce_bin)
 
     def build_fake_broadcast_args(self):
         job_id = '00'
@@ -112,7 +146,7 @@ class BlockTemplate(halfnode.CBlock):
     def build_broadcast_args(self):
         job_id = self.job_id
         prevhash = binascii.hexlify(self.prevhash_bin)
-        (coinb1, coinb2) = [ binascii.hexlify(x) for x in self.vtx[0]._serialized ]
+        (coinb1, coinb2) = [ binascii.hexlify(x) for x in self.coinbase._serialized ]
         merkle_branch = [ binascii.hexlify(x) for x in self.merkletree._steps ]
         version = binascii.hexlify(struct.pack("<i", self.nVersion))
         nbits = binascii.hexlify(struct.pack("<I", self.nBits))
@@ -122,12 +156,33 @@ class BlockTemplate(halfnode.CBlock):
         
         return (job_id, prevhash, coinb1, coinb2, merkle_branch, version, nbits, ntime, nTxTime, clean_jobs)
 
+    def build_notify_tails(self):
+        '''Encodes mining.notify params following the job id once per template,
+        for clean_jobs False and True'''
+        params = json.dumps(list(self.broadcast_args[1:9]))[1:-1]
+        return tuple([ '%s, %s], "id": null, "method": "mining.notify"}\n' % (params, clean_jobs)
+                       for clean_jobs in ('false', 'true') ])
+
+    def serialize_notify(self, work_id, clean_jobs):
+        '''Returns mining.notify line of this template for given work id,
+        the same what Protocol.writeJsonRequest would send.
+        Work ids are hex strings, so they don't need JSON escaping.'''
+        return '{"params": ["%s", %s' % (work_id, self.notify_tails[bool(clean_jobs)])
+
     def serialize_coinbase(self, extranonce1, extranonce2):
         '''Serialize coinbase with given extranonce1 and extranonce2
         in binary form'''
-        (part1, part2) = self.vtx[0]._serialized
+        (part1, part2) = self.coinbase._serialized
         return part1 + extranonce1 + extranonce2 + part2
     
+    def serialize_txs(self, extranonce1, extranonce2):
+        '''Serialize transactions of the block with given extranonce1
+        and extranonce2 in hex form, as expected by submitblock'''
+        coinbase = self.serialize_coinbase(extranonce1, extranonce2)
+        # Joined only here, when a block is found
+        return binascii.hexlify(util.ser_compact_size(self.tx_count) + coinbase) + \
+               ''.join([ tx.data_hex for tx in self.txs ])
+    
     def check_ntime(self, ntime):
         '''Check for ntime restrictions.'''
         if ntime < self.curtime:
@@ -138,23 +193,20 @@ class BlockTemplate(halfnode.CBlock):
             return False        
         return True
 
+    def serialize_header_parts(self, ntime_bin, nonce_bin):
+        '''Returns header serialized before and after the merkle root,
+        so the header can be completed once the merkle root is known.
+        ntime_bin and nonce_bin are little-endian, as sent by the miner.'''
+        return (self.header_head, self.header_mid + ntime_bin + nonce_bin)
+
     def serialize_header(self, merkle_root_int, ntime_bin, nonce_bin):
-        r = struct.pack("<i", self.nVersion)
-        r += struct.pack("<i", self.nRegion)
-        r += self.prevhash_bin
-        r += merkle_root_int
-        r += struct.pack("<Q", self.nTxTime)
-        r += struct.pack("<Q", self.nHashCoin)
-        r += struct.pack("<I", self.sigchecksum)
-        r += struct.pack("<I", self.nBits)
-        r += struct.pack("<I", ntime_bin)
-        r += struct.pack("<I", nonce_bin)
-        return r   
+        (head, tail) = self.serialize_header_parts(ntime_bin, nonce_bin)
+        return head + merkle_root_int + tail
 
     def finalize(self, merkle_root_int, extranonce1_bin, extranonce2_bin, ntime, nonce):       
         self.hashMerkleRoot = merkle_root_int
         self.nTime = ntime
         self.nNonce = nonce
-        self.vtx[0].set_extranonce(extranonce1_bin + extranonce2_bin)        
+        self.coinbase.set_extranonce(extranonce1_bin + extranonce2_bin)        
         self.powhash320 = None      
 
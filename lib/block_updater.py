@@ -1,4 +1,4 @@
-from twisted.internet import reactor, defer
+from twisted.internet import reactor, defer, task
 import settings
 
 import util
@@ -14,13 +14,22 @@ class BlockUpdater(object):
         
         This is just failback alternative when something
         with ./litecoind -blocknotify will go wrong. 
+
+        With GBT_LONGPOLL, getblocktemplate long poll request is kept
+        outstanding and the daemon answers it with new template right
+        away. Polling then only runs as a slower watchdog.
     '''
     
     def __init__(self, registry, bitcoin_rpc):
         self.bitcoin_rpc = bitcoin_rpc
         self.registry = registry
         self.clock = None
+        self.interval = settings.PREVHASH_REFRESH_INTERVAL
+        self.longpollid = None
         self.schedule()
+
+        if settings.GBT_LONGPOLL:
+            self.longpoll()
                         
     def schedule(self):
         when = self._get_next_time()
@@ -30,9 +39,51 @@ class BlockUpdater(object):
         self.clock = reactor.callLater(when, self.run)
         
     def _get_next_time(self):
-        when = settings.PREVHASH_REFRESH_INTERVAL - (Interfaces.timestamper.time() - self.registry.last_update) % \
-               settings.PREVHASH_REFRESH_INTERVAL
+        when = self.interval - (Interfaces.timestamper.time() - self.registry.last_update) % self.interval
         return when  
+
+    @defer.inlineCallbacks
+    def longpoll(self):
+        while True:
+            last_block = self.registry.last_block
+            longpollid = self.longpollid or (last_block and last_block.longpollid)
+
+            if not longpollid:
+                if last_block and last_block.tx_count:
+                    log.warning("Daemon does not support long polling, polling every %d sec" % self.interval)
+                    return
+                # Waiting for first template
+                yield task.deferLater(reactor, 1, lambda: None)
+                continue
+
+            self.interval = settings.LONGPOLL_WATCHDOG_INTERVAL
+            try:
+                template = (yield self.bitcoin_rpc.getblocktemplate_longpoll(longpollid, settings.LONGPOLL_TIMEOUT))
+            except defer.TimeoutError:
+                log.debug("Long poll timed out, restarting")
+                continue
+            except Exception:
+                log.exception("Long poll failed")
+                self.longpollid = None
+                self.interval = settings.PREVHASH_REFRESH_INTERVAL
+                yield task.deferLater(reactor, settings.PREVHASH_REFRESH_INTERVAL, lambda: None)
+                continue
+
+            self.longpollid = template.get('longpollid')
+            if self.registry.last_block and self.longpollid == self.registry.last_block.longpollid:
+                # Template has been already updated by blocknotify or the watchdog
+                continue
+
+            log.info("Long poll returned new template")
+            last_block = self.registry.last_block
+            while self.registry.update_block(template) == None:
+                # Another update is running, the daemon won't answer this longpollid again
+                yield task.deferLater(reactor, 0.1, lambda: None)
+                if self.registry.last_block is not last_block:
+                    # The running update installed a template at least as recent as this one,
+                    # applying this one could go back to the previous block
+                    log.info("Long poll template superseded by another update")
+                    break
                      
     @defer.inlineCallbacks
     def run(self):
@@ -45,17 +96,24 @@ class BlockUpdater(object):
                 current_prevhash = None
   
             log.debug("Checking for new block.")
-            prevhash = util.rev((yield self.bitcoin_rpc.prevhash()))
+            merkle_update = Interfaces.timestamper.time() - self.registry.last_update >= settings.MERKLE_REFRESH_INTERVAL
+            if merkle_update:
+                # New template is needed anyway, fetch it together with prevhash
+                (prevhash, template) = (yield self.bitcoin_rpc.prevhash_and_template())
+            else:
+                (prevhash, template) = ((yield self.bitcoin_rpc.prevhash()), None)
+
+            prevhash = util.rev(prevhash)
             if prevhash and prevhash != current_prevhash:
                 log.info("New block! Prevhash: %s" % prevhash)
                 update = True
             
-            elif Interfaces.timestamper.time() - self.registry.last_update >= settings.MERKLE_REFRESH_INTERVAL:
+            elif merkle_update:
                 log.info("Merkle update! Prevhash: %s" % prevhash)
                 update = True
                 
             if update:
-                self.registry.update_block()
+                self.registry.update_block(template)
 
         except Exception:
             log.exception("UpdateWatchdog.run failed")
@@ -51,3 +51,17 @@ class SimpleCoinbaser(object):
     def get_coinbase_data(self):
         return ''
 
+class ResolvedCoinbaser(object):
+    '''Values of another coinbaser, resolved on the reactor thread.
+    Used for templates built in a worker thread, where the coinbaser
+    must not call the coin daemon.'''
+
+    def __init__(self, coinbaser):
+        self.script_pubkey = coinbaser.get_script_pubkey()
+        self.coinbase_data = coinbaser.get_coinbase_data()
+
+    def get_script_pubkey(self):
+        return self.script_pubkey
+
+    def get_coinbase_data(self):
+        return self.coinbase_data
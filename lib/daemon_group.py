@@ -0,0 +1,199 @@
+'''Several coin daemons behind the interface of BitcoinRPC.
+
+New blocks are detected by polling all daemons and the daemon which
+reports new prevhash first becomes the leader, templates are fetched
+from it. Found blocks are submitted to all daemons in parallel.'''
+
+import time
+
+from twisted.internet import defer
+from twisted.python import failure
+
+import lib.logger
+log = lib.logger.get_logger('daemon_group')
+
+class DaemonState(object):
+    '''Latency and health of single daemon of the group'''
+
+    # Weight of the last call in latency average
+    ALPHA = 0.2
+    # Daemon is skipped after so many failures in a row
+    MAX_FAILURES = 3
+
+    def __init__(self, rpc):
+        self.rpc = rpc
+        self.name = rpc.bitcoin_url
+        self.latency = None
+        self.calls = 0
+        self.failures = 0
+        self.failures_in_row = 0
+
+    def is_healthy(self):
+        return self.failures_in_row < self.MAX_FAILURES
+
+    def track(self, d):
+        '''Records latency and result of RPC call Deferred, passes the result through'''
+        d.addBoth(self._done, time.time())
+        return d
+
+    def _done(self, result, start):
+        self.calls += 1
+        if isinstance(result, failure.Failure):
+            self.failures += 1
+            self.failures_in_row += 1
+            if self.failures_in_row == self.MAX_FAILURES:
+                log.warning("Daemon %s is failing: %s" % (self.name, result.getErrorMessage()))
+            return result
+
+        if not self.is_healthy():
+            log.info("Daemon %s is back" % self.name)
+        self.failures_in_row = 0
+
+        latency = time.time() - start
+        if self.latency == None:
+            self.latency = latency
+        else:
+            self.latency += self.ALPHA * (latency - self.latency)
+        return result
+
+    def get_stats(self):
+        return {
+            'healthy': self.is_healthy(),
+            'latency_ms': self.latency * 1000 if self.latency != None else None,
+            'calls': self.calls,
+            'failures': self.failures,
+            'failures_in_row': self.failures_in_row,
+            'rpc': self.rpc.get_stats(),
+        }
+
+class DaemonGroup(object):
+    '''Drop-in replacement of BitcoinRPC using several daemons.
+    Calls without special handling go to the current leader.'''
+
+    def __init__(self, rpcs):
+        self.daemons = [ DaemonState(rpc) for rpc in rpcs ]
+        self.leader = self.daemons[0]
+        self.last_prevhash = None
+        self.recent_prevhashes = [] # lagging daemons may still report these
+        self.longpoll_daemon = None # longpollid is only known to the daemon which issued it
+        self.bitcoin_url = ', '.join([ d.name for d in self.daemons ])
+
+    def __getattr__(self, name):
+        # validateaddress, getinfo, batch etc.
+        return getattr(self._get_leader().rpc, name)
+
+    def _get_leader(self):
+        if not self.leader.is_healthy():
+            healthy = [ d for d in self.daemons if d.is_healthy() ]
+            if healthy:
+                # Daemons without measured latency come last
+                self.leader = min(healthy, key=lambda d: (d.latency == None, d.latency))
+                log.info("Daemon %s is the new leader" % self.leader.name)
+        return self.leader
+
+    def prevhash(self):
+        '''Asks all daemons for prevhash. Fires with the first prevhash which
+        has not been seen yet, its daemon becomes the leader.
+        Fires with the last known prevhash once all daemons answered.'''
+        result = defer.Deferred()
+        pending = [len(self.daemons)]
+        errors = []
+
+        for daemon in self.daemons:
+            d = daemon.track(daemon.rpc.prevhash())
+            d.addCallbacks(self._got_prevhash, errors.append, callbackArgs=(daemon, result))
+            d.addBoth(self._prevhash_done, result, pending, errors)
+        return result
+
+    def _got_prevhash(self, prevhash, daemon, result):
+        if result.called or prevhash in self.recent_prevhashes:
+            return
+
+        if self.last_prevhash != None and daemon != self.leader:
+            log.info("Daemon %s reported new block first" % daemon.name)
+        self.last_prevhash = prevhash
+        self.recent_prevhashes = self.recent_prevhashes[-15:] + [prevhash]
+        self.leader = daemon
+        result.callback(prevhash)
+
+    def _prevhash_done(self, _, result, pending, errors):
+        pending[0] -= 1
+        if pending[0] or result.called:
+            return
+
+        if len(errors) == len(self.daemons):
+            result.errback(errors[0])
+        else:
+            result.callback(self.last_prevhash)
+
+    def prevhash_and_template(self):
+        # Merkle refresh, new blocks are detected by prevhash()
+        leader = self._get_leader()
+        return leader.track(leader.rpc.prevhash_and_template())
+
+    @defer.inlineCallbacks
+    def getblocktemplate(self, raw=False):
+        '''Template of the leader, other healthy daemons are tried when it fails'''
+        leader = self._get_leader()
+        daemons = [leader] + [ d for d in self.daemons if d != leader and d.is_healthy() ]
+
+        for daemon in daemons:
+            try:
+                template = (yield daemon.track(daemon.rpc.getblocktemplate(raw)))
+            except Exception as e:
+                log.error("getblocktemplate of %s failed: %s" % (daemon.name, str(e)))
+                error = e
+                continue
+            defer.returnValue(template)
+        raise error
+
+    def getblocktemplate_longpoll(self, longpollid, timeout):
+        '''Long polls the leader. After the leader has changed, its template
+        is returned right away, the next long poll then uses its longpollid.'''
+        leader = self._get_leader()
+        if leader != self.longpoll_daemon:
+            if self.longpoll_daemon != None:
+                log.info("Long polling moves to %s" % leader.name)
+            self.longpoll_daemon = leader
+            return leader.track(leader.rpc.getblocktemplate())
+        # Not tracked, the call waits for the next template on purpose
+        return leader.rpc.getblocktemplate_longpoll(longpollid, timeout)
+
+    def submitblock_wtxs(self, block_hex, txs, block_hash_hex):
+        '''Submits block to all daemons in parallel. Fires with True as soon
+        as any daemon accepts it, otherwise with result of the leader.'''
+        result = defer.Deferred()
+        calls = []
+
+        for daemon in self.daemons:
+            d = daemon.track(daemon.rpc.submitblock_wtxs(block_hex, txs, block_hash_hex))
+            d.addBoth(self._submitted, daemon, block_hash_hex, result)
+            calls.append(d)
+
+        d = defer.DeferredList(calls)
+        d.addCallback(self._submit_done, result)
+        return result
+
+    def _submitted(self, accepted, daemon, block_hash_hex, result):
+        if isinstance(accepted, failure.Failure):
+            log.error("Block %s not submitted to %s: %s" % (block_hash_hex, daemon.name, accepted.getErrorMessage()))
+        else:
+            log.info("Block %s submitted to %s, accepted: %s" % (block_hash_hex, daemon.name, accepted))
+            if accepted == True and not result.called:
+                result.callback(True)
+        return (daemon, accepted)
+
+    def _submit_done(self, results, result):
+        if result.called:
+            return
+
+        for (_, (daemon, accepted)) in results:
+            if daemon == self.leader:
+                if isinstance(accepted, failure.Failure):
+                    result.errback(accepted)
+                else:
+                    result.callback(accepted)
+                return
+
+    def get_stats(self):
+        return dict((d.name, dict(d.get_stats(), leader=(d == self.leader))) for d in self.daemons)
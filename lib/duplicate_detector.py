@@ -0,0 +1,49 @@
+from lib.exceptions import SubmitException
+
+import lib.logger
+log = lib.logger.get_logger('duplicate_detector')
+
+class DuplicateDetector(object):
+    '''Exact detection of duplicated submits of a single job.
+
+    Submits are stored as packed binary keys (extranonce2 + ntime + nonce)
+    in sets partitioned by extranonce1, so the check costs the same
+    no matter how many shares the job already received.
+
+    Memory is capped by max_keys per extranonce1. Forgetting old keys
+    would let duplicates through, so once the cap is reached, new submits
+    of that connection are refused until it switches to a newer job.
+    Other connections are not affected.'''
+
+    def __init__(self, max_keys):
+        self.max_keys = max_keys
+        self.count = 0
+        self.partitions = {}
+
+    def register(self, extranonce1_bin, extranonce2_bin, ntime_bin, nonce_bin):
+        '''Returns True for unique submit, False for duplicate'''
+        key = extranonce2_bin + ntime_bin + nonce_bin
+
+        partition = self.partitions.get(extranonce1_bin)
+        if partition == None:
+            # Created with the first key, refused submits don't allocate anything
+            partition = self.partitions[extranonce1_bin] = set([key])
+        elif key in partition:
+            return False
+        elif len(partition) >= self.max_keys:
+            raise SubmitException("Too many shares for this job")
+        else:
+            partition.add(key)
+
+        self.count += 1
+        if len(partition) == self.max_keys:
+            log.warning("Duplicate detector is full for extranonce1 %s (%d submits)" % \
+                        (extranonce1_bin.encode('hex'), self.max_keys))
+        return True
+
+    def clear(self):
+        self.partitions = {}
+        self.count = 0
+
+    def __len__(self):
+        return self.count
@@ -1,4 +1,12 @@
 from stratum.custom_exceptions import ServiceException
 
 class SubmitException(ServiceException):
-    pass
\ No newline at end of file
+    pass
+
+class ExtranonceException(ServiceException):
+    '''No extranonce1 is free for new subscription'''
+    pass
+
+class RPCError(Exception):
+    '''Error returned by the coin daemon for a single call of batch request'''
+    pass
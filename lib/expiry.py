@@ -0,0 +1,146 @@
+'''Expiry of idle entries in the in-memory caches of the pool.
+
+One hierarchical timing wheel driven by the reactor serves all caches.
+Adding, touching and discarding a key is O(1), every tick only looks
+at the keys due in that tick. Caches register as owners and get
+a callback for every expired key; use MiningService.get_expiry_stats
+admin call to see entry counts and evictions.'''
+
+import time
+
+import lib.logger
+log = lib.logger.get_logger('expiry')
+
+class TimingWheel(object):
+    '''Hierarchical timing wheel of items with deadlines in ticks.
+
+    Level 0 has a slot per tick, every higher level has a slot per
+    revolution of the level below, and its items are cascaded down
+    when the lower level gets there. Deadlines are looked up when
+    a slot is processed, so touch only updates the deadline and the
+    item moves once its old slot comes around.'''
+
+    def __init__(self, slots=64, levels=4):
+        self.slots = slots
+        self.levels = levels
+        self.wheels = [ [ set() for _ in xrange(slots) ] for _ in xrange(levels) ]
+        self.tick = 0
+        self.deadlines = {}
+
+    def add(self, item, deadline):
+        '''Schedules new item or moves deadline of existing one later'''
+        if item not in self.deadlines:
+            self._place(item, max(deadline, self.tick + 1))
+        self.deadlines[item] = deadline
+
+    def discard(self, item):
+        # Stays in its slot until the slot is processed
+        self.deadlines.pop(item, None)
+
+    def _place(self, item, deadline):
+        delta = deadline - self.tick
+        (level, span) = (0, 1)
+        while level < self.levels - 1 and delta >= span * self.slots:
+            (level, span) = (level + 1, span * self.slots)
+        if delta >= span * self.slots:
+            # Beyond the wheel, waits in the farthest slot of the top level
+            deadline = self.tick + span * (self.slots - 1)
+        self.wheels[level][(deadline // span) % self.slots].add(item)
+
+    def advance(self):
+        '''Moves to the next tick, returns items which expired'''
+        self.tick += 1
+        (level, span) = (1, self.slots)
+        while level < self.levels and self.tick % span == 0:
+            # Lower level made a full revolution, spread the next slot of this level over it,
+            # items due now go to the level 0 slot processed below
+            self._process(self.wheels[level], (self.tick // span) % self.slots, None)
+            (level, span) = (level + 1, span * self.slots)
+
+        expired = []
+        self._process(self.wheels[0], self.tick % self.slots, expired)
+        return expired
+
+    def _process(self, wheel, index, expired):
+        items = wheel[index]
+        wheel[index] = set()
+        for item in items:
+            deadline = self.deadlines.get(item)
+            if deadline == None:
+                continue
+            if deadline <= self.tick and expired != None:
+                del self.deadlines[item]
+                expired.append(item)
+            else:
+                self._place(item, deadline)
+
+class ExpiryOwner(object):
+    '''Keys of one cache in the expiry service'''
+
+    def __init__(self, service, name, on_expire):
+        self.service = service
+        self.name = name
+        self.on_expire = on_expire
+        self.keys = set()
+        self.evictions = 0
+
+    def add(self, key, ttl):
+        '''Key expires ttl seconds from now unless touched again'''
+        self.keys.add(key)
+        self.service.wheel.add((self, key), self.service.deadline(ttl))
+
+    touch = add
+
+    def discard(self, key):
+        self.keys.discard(key)
+        self.service.wheel.discard((self, key))
+
+    def clear(self):
+        for key in self.keys:
+            self.service.wheel.discard((self, key))
+        self.keys = set()
+
+    def get_stats(self):
+        return {'entries': len(self.keys), 'evictions': self.evictions}
+
+class ExpiryService(object):
+    '''Timing wheel with LoopingCall ticking every resolution seconds'''
+
+    def __init__(self, resolution=1.0):
+        self.resolution = resolution
+        self.wheel = TimingWheel()
+        self.owners = {}
+        self.start_time = time.time()
+        self.loop = None
+
+    def register(self, name, on_expire):
+        '''Returns ExpiryOwner calling on_expire(key) for expired keys'''
+        owner = ExpiryOwner(self, name, on_expire)
+        self.owners[name] = owner
+        return owner
+
+    def deadline(self, ttl):
+        return int((time.time() - self.start_time + ttl) / self.resolution) + 1
+
+    def start(self):
+        from twisted.internet import task
+        if self.loop == None:
+            self.loop = task.LoopingCall(self._tick)
+            self.loop.start(self.resolution, now=False)
+
+    def _tick(self):
+        # Catches up when the reactor has been busy
+        now = int((time.time() - self.start_time) / self.resolution)
+        while self.wheel.tick < now:
+            for (owner, key) in self.wheel.advance():
+                owner.keys.discard(key)
+                owner.evictions += 1
+                try:
+                    owner.on_expire(key)
+                except Exception:
+                    log.exception("Expiry of %s in %s failed" % (key, owner.name))
+
+    def get_stats(self):
+        return dict((name, owner.get_stats()) for (name, owner) in self.owners.items())
+
+expiry = ExpiryService()
@@ -1,27 +1,93 @@
 import struct
+import time
+from collections import deque
+
+from lib.exceptions import ExtranonceException
+
 import lib.logger
-log = lib.logger.get_logger('extronance')
+log = lib.logger.get_logger('extranonce')
 
 class ExtranonceCounter(object):
-    '''Implementation of a counter producing
-       unique extranonce across all pool instances.
-       This is just dumb "quick&dirty" solution,
-       but it can be changed at any time without breaking anything.'''       
-
-    def __init__(self, instance_id):
-        if instance_id < 0 or instance_id > 31:
-            raise Exception("Current ExtranonceCounter implementation needs an instance_id in <0, 31>.")
-
-        # Last 5 most-significant bits represents instance_id
-        # The rest is just an iterator of jobs.
-        self.counter = instance_id << 27
+    '''Allocator of extranonce1 unique across all pool instances.
+
+       Most-significant instance_bits of the 32-bit extranonce1 hold
+       instance_id, the rest is a counter of this instance. Extranonce1
+       of a closed connection is released and given out again after
+       quarantine seconds, when shares and cached stats of the old
+       connection are gone. Allocation fails instead of wrapping
+       into the range of another instance.'''
+
+    def __init__(self, instance_id, instance_bits=5, quarantine=900):
+        if instance_bits < 0 or instance_bits > 31:
+            raise Exception("ExtranonceCounter needs instance_bits in <0, 31>.")
+        if instance_id < 0 or instance_id >= 1 << instance_bits:
+            raise Exception("ExtranonceCounter with %d instance bits needs an instance_id in <0, %d>." % \
+                            (instance_bits, (1 << instance_bits) - 1))
+
+        self.instance_id = instance_id
+        self.instance_bits = instance_bits
+        self.quarantine = quarantine
         self.size = struct.calcsize('>L')
-        
+
+        counter_bits = 32 - instance_bits
+        self.base = instance_id << counter_bits
+        # Counter 0 is never given out
+        self.capacity = (1 << counter_bits) - 1
+
+        self.counter = 0            # Highest counter given out so far
+        self.in_use = set()
+        self.released = deque()     # (release time, extranonce1), oldest first
+
+        self.allocations = 0
+        self.recycled = 0
+        self.releases = 0
+        self.exhausted = 0
+        self.last_exhausted_log = 0
+
     def get_size(self):
         '''Return expected size of generated extranonce in bytes'''
         return self.size
-    
+
     def get_new_bin(self):
-        self.counter += 1
-        return struct.pack('>L', self.counter)
-        
+        if self.released and self.released[0][0] + self.quarantine <= time.time():
+            extranonce1 = self.released.popleft()[1]
+            self.recycled += 1
+        elif self.counter < self.capacity:
+            self.counter += 1
+            extranonce1 = struct.pack('>L', self.base + self.counter)
+        else:
+            self.exhausted += 1
+            now = time.time()
+            if now - self.last_exhausted_log >= 60:
+                # Miners keep reconnecting, log once a minute
+                self.last_exhausted_log = now
+                log.error("All %d extranonce1 values of instance %d are in use or in quarantine, %d subscriptions refused" % \
+                          (self.capacity, self.instance_id, self.exhausted))
+            raise ExtranonceException("No free extranonce1 on this pool instance, try again later")
+
+        self.in_use.add(extranonce1)
+        self.allocations += 1
+        return extranonce1
+
+    def release(self, extranonce1):
+        '''Returns extranonce1 of closed connection, it is reused after the quarantine'''
+        if extranonce1 not in self.in_use:
+            return
+        self.in_use.remove(extranonce1)
+        self.released.append((time.time(), extranonce1))
+        self.releases += 1
+
+    def get_stats(self):
+        return {
+            'instance_id': self.instance_id,
+            'instance_bits': self.instance_bits,
+            'capacity': self.capacity,
+            'in_use': len(self.in_use),
+            'quarantined': len(self.released),
+            'never_used': self.capacity - self.counter,
+            'occupancy': float(len(self.in_use) + len(self.released)) / self.capacity,
+            'allocations': self.allocations,
+            'recycled': self.recycled,
+            'releases': self.releases,
+            'exhausted': self.exhausted,
+        }
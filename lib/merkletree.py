@@ -17,9 +17,47 @@ from hashlib import sha256
 from util import doublesha
 import kshake320_hash
 
+class PairHashCache(object):
+    '''Bounded memo of interior merkle node hashes keyed by child pair.
+
+    Templates refreshed from the same mempool share most of their
+    interior nodes, so only the new ones are hashed. Entries live
+    in two generations: used entries are promoted to the current one
+    and the older generation is dropped once the current is full,
+    which keeps recently used nodes like LRU but costs a dict lookup.'''
+
+    def __init__(self, size):
+        self.size = size
+        self.current = {}
+        self.previous = {}
+        self.hits = 0
+        self.misses = 0
+
+    def hash_pair(self, pair):
+        try:
+            h = self.current[pair]
+            self.hits += 1
+            return h
+        except KeyError:
+            pass
+
+        h = self.previous.get(pair)
+        if h == None:
+            h = kshake320_hash.getHash320(pair)
+            self.misses += 1
+        else:
+            self.hits += 1
+
+        if len(self.current) >= self.size:
+            self.previous = self.current
+            self.current = {}
+        self.current[pair] = h
+        return h
+
 class MerkleTree:
-    def __init__(self, data, detailed=False):
+    def __init__(self, data, detailed=False, cache=None):
         self.data = data
+        self.cache = cache
         self.recalculate(detailed)
         self._hash_steps = None
     
@@ -34,6 +72,10 @@ class MerkleTree:
             detail = None
             PreL = [None]
             StartL = 2
+        if self.cache != None:
+            hash_pair = self.cache.hash_pair
+        else:
+            hash_pair = kshake320_hash.getHash320
         Ll = len(L)
         if detailed or Ll > 1:
             while True:
@@ -44,7 +86,7 @@ class MerkleTree:
                 steps.append(L[1])
                 if Ll % 2:
                     L += [L[-1]]
-                L = PreL + [kshake320_hash.getHash320(L[i] + L[i + 1]) for i in range(StartL, Ll, 2)]
+                L = PreL + [hash_pair(L[i] + L[i + 1]) for i in range(StartL, Ll, 2)]
                 Ll = len(L)
         self._steps = steps
         self.detail = detail
@@ -0,0 +1,90 @@
+'''Offloads share hashing from the reactor thread.
+
+TemplateRegistry does all cheap checks of the share on the reactor
+and asks ShareHasher for the expensive part (coinbase hash, merkle branch
+and PoW hash). Results are always delivered back in the reactor thread.'''
+
+import multiprocessing
+import time
+import traceback
+
+from twisted.internet import defer, reactor, threads
+from twisted.python import threadpool
+
+import kshake320_hash
+
+import lib.logger
+log = lib.logger.get_logger('share_hasher')
+
+def hash_share(coinbase_bin, merkle_steps, header_head, header_tail):
+    '''Returns (merkle_root_bin, header_bin, hash_bin, timings) of given share,
+    timings are seconds spent in (coinbase + merkle, PoW) hashing.
+    This is module-level function, so it can be pickled to worker processes.'''
+    start = time.time()
+    merkle_root_bin = kshake320_hash.getHash320(coinbase_bin)
+    for s in merkle_steps:
+        merkle_root_bin = kshake320_hash.getHash320(merkle_root_bin + s)
+
+    header_bin = header_head + merkle_root_bin + header_tail
+    merkle_done = time.time()
+    hash_bin = kshake320_hash.getPoWHash(header_bin)
+    return (merkle_root_bin, header_bin, hash_bin, (merkle_done - start, time.time() - merkle_done))
+
+def _hash_share_safe(args):
+    # multiprocessing.Pool in python 2.7 has no error callback,
+    # so the exception is passed back as a part of the result.
+    try:
+        return (True, hash_share(*args))
+    except Exception:
+        return (False, traceback.format_exc())
+
+class ShareHasher(object):
+    '''Pool of workers computing share hashes.
+
+    mode is 'process' (scales with CPU cores), 'thread' (useful only
+    when kshake320_hash releases the GIL) or 'inline' (hash directly
+    on the reactor thread, like in the old days).'''
+
+    def __init__(self, mode='inline', workers=0):
+        if not workers:
+            workers = multiprocessing.cpu_count()
+
+        self.mode = mode
+        self.workers = workers
+
+        if mode == 'process':
+            self.pool = multiprocessing.Pool(workers)
+            reactor.addSystemEventTrigger('after', 'shutdown', self.pool.terminate)
+        elif mode == 'thread':
+            self.pool = threadpool.ThreadPool(workers, workers, 'share_hasher')
+            self.pool.start()
+            reactor.addSystemEventTrigger('during', 'shutdown', self.pool.stop)
+        elif mode == 'inline':
+            self.pool = None
+        else:
+            raise Exception("Unknown share hashing mode '%s'" % mode)
+
+        log.info("Share hashing mode: %s, %d workers" % (mode, workers if self.pool else 0))
+
+    def hash_share(self, coinbase_bin, merkle_steps, header_head, header_tail):
+        '''Returns Deferred firing with result of hash_share()'''
+        args = (coinbase_bin, merkle_steps, header_head, header_tail)
+
+        if self.mode == 'process':
+            d = defer.Deferred()
+            self.pool.apply_async(_hash_share_safe, (args,),
+                                  callback=lambda result: reactor.callFromThread(self._process_done, d, result))
+            return d
+
+        if self.mode == 'thread':
+            return threads.deferToThreadPool(reactor, self.pool, hash_share, *args)
+
+        return defer.maybeDeferred(hash_share, *args)
+
+    def _process_done(self, d, result):
+        (ok, value) = result
+        if ok:
+            d.callback(value)
+        else:
+            log.error("Share hashing failed: %s" % value)
+            d.errback(Exception("Share hashing failed"))
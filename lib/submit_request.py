@@ -0,0 +1,38 @@
+import binascii
+import re
+import struct
+
+from lib.exceptions import SubmitException
+
+_hex_re = re.compile(r'\A[0-9a-fA-F]*\Z')
+
+def _decode(name, value, size):
+    '''Checks length and charset of hex field before decoding it'''
+    if not isinstance(value, basestring):
+        raise SubmitException("Malformed %s" % name)
+
+    if len(value) != size * 2:
+        raise SubmitException("Incorrect size of %s. Expected %d chars" % (name, size * 2))
+
+    if not _hex_re.match(value):
+        raise SubmitException("Malformed %s" % name)
+
+    return binascii.unhexlify(value)
+
+class SubmitRequest(object):
+    '''Parameters of mining.submit decoded exactly once.
+
+    ntime and nonce are sent by miners as hex of the little-endian
+    bytes, so ntime_bin and nonce_bin go to the block header as they are.'''
+
+    __slots__ = ('worker_name', 'job', 'extranonce1_bin', 'extranonce2_bin',
+                 'ntime_bin', 'nonce_bin', 'ntime', 'nonce')
+
+    def __init__(self, worker_name, job, extranonce1_bin, extranonce2, ntime, nonce, extranonce2_size):
+        self.worker_name = worker_name
+        self.job = job
+        self.extranonce1_bin = extranonce1_bin
+        self.extranonce2_bin = _decode('extranonce2', extranonce2, extranonce2_size)
+        self.ntime_bin = _decode('ntime', ntime, 4)
+        self.nonce_bin = _decode('nonce', nonce, 4)
+        (self.ntime, self.nonce) = struct.unpack("<II", self.ntime_bin + self.nonce_bin)
@@ -0,0 +1,118 @@
+'''In-memory latency histograms and reject counters of the submit path.
+
+Cheap enough to be always enabled; use MiningService.get_submit_stats
+admin call to read them.'''
+
+import re
+import time
+
+class LatencyHistogram(object):
+    '''HDR-style histogram of latencies in microseconds.
+
+    Values below 64 us have their own bucket, larger values are
+    grouped into 32 buckets per power of two, so every bucket
+    is within ~3% of the recorded values.'''
+
+    SUB_BUCKETS = 32
+    MAX_SHIFT = 31 # ~ 19 hours, larger values are clamped
+
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        self.counts = [0] * (self.SUB_BUCKETS * (self.MAX_SHIFT + 2))
+        self.count = 0
+        self.total = 0
+        self.min = None
+        self.max = 0
+
+    def record(self, seconds):
+        v = int(seconds * 1000000)
+        if v < 0:
+            v = 0
+
+        shift = v.bit_length() - 6
+        if shift <= 0:
+            index = v
+        elif shift > self.MAX_SHIFT:
+            index = len(self.counts) - 1
+        else:
+            index = (shift << 5) + (v >> shift)
+
+        self.counts[index] += 1
+        self.count += 1
+        self.total += v
+        if v > self.max:
+            self.max = v
+        if self.min == None or v < self.min:
+            self.min = v
+
+    def _bucket_value(self, index):
+        if index < 2 * self.SUB_BUCKETS:
+            return index
+        shift = index // self.SUB_BUCKETS - 1
+        return (index - self.SUB_BUCKETS * shift) << shift
+
+    def percentile(self, p):
+        '''Returns latency in microseconds for given percentile (0-100)'''
+        if not self.count:
+            return 0
+        rank = max(1, int(round(self.count * p / 100.0)))
+        seen = 0
+        for index, c in enumerate(self.counts):
+            seen += c
+            if seen >= rank:
+                return min(self._bucket_value(index), self.max)
+        return self.max
+
+    def get_stats(self):
+        '''Summary of the histogram, values are in milliseconds'''
+        if not self.count:
+            return {'count': 0}
+
+        return {
+            'count': self.count,
+            'min': self.min / 1000.0,
+            'mean': self.total / 1000.0 / self.count,
+            'p50': self.percentile(50) / 1000.0,
+            'p90': self.percentile(90) / 1000.0,
+            'p99': self.percentile(99) / 1000.0,
+            'p999': self.percentile(99.9) / 1000.0,
+            'max': self.max / 1000.0,
+        }
+
+class SubmitStats(object):
+    '''Per-stage latencies of mining.submit and counters of reject reasons'''
+
+    # Variable parts of reject messages (job ids etc.) are quoted
+    _quoted = re.compile(r"'[^']*'")
+
+    def __init__(self):
+        self.stages = {}
+        self.rejects = {}
+        self.since = time.time()
+
+    def record(self, stage, seconds):
+        try:
+            self.stages[stage].record(seconds)
+        except KeyError:
+            self.stages[stage] = LatencyHistogram()
+            self.stages[stage].record(seconds)
+
+    def record_reject(self, reason):
+        reason = self._quoted.sub("'*'", str(reason))
+        self.rejects[reason] = self.rejects.get(reason, 0) + 1
+
+    def get_stats(self):
+        return {
+            'since': self.since,
+            'stages': dict((name, h.get_stats()) for (name, h) in self.stages.items()),
+            'rejects': dict(self.rejects),
+        }
+
+    def reset(self):
+        self.stages = {}
+        self.rejects = {}
+        self.since = time.time()
+
+submit_stats = SubmitStats()
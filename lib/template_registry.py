@@ -4,18 +4,31 @@ import util
 import StringIO
 import settings
 import struct
+import fractions
+import time
+import simplejson as json
 
-from twisted.internet import defer
+from twisted.internet import defer, threads
 from lib.exceptions import SubmitException
 
 import lib.logger
 log = lib.logger.get_logger('template_registry')
 from mining.interfaces import Interfaces
 from extranonce_counter import ExtranonceCounter
+from share_hasher import ShareHasher
+from tx_cache import TxCache
+from coinbaser import ResolvedCoinbaser
+import merkletree
+from submit_stats import submit_stats
+from submit_request import SubmitRequest
 import lib.settings as settings
 
 import kshake320_hash
 
+# Target of the share with difficulty 1
+DIFF1_TARGET = 0x000000ffff000000000000000000000000000000000000000000000000000000000000000000000 * 16
+MAX_TARGET = 2**320 - 1
+
 class JobIdGenerator(object):
     '''Generate pseudo-unique job_id. It does not need to be absolutely unique,
     because pool sends "clean_jobs" flag to clients and they should drop all previous jobs.'''
@@ -34,24 +47,36 @@ class TemplateRegistry(object):
     service and implements block validation and submits.'''
     
     def __init__(self, block_template_class, coinbaser, bitcoin_rpc, instance_id,
-                 on_template_callback, on_block_callback):
+                 on_template_callback, on_block_callback, share_hasher=None):
         self.prevhashes = {}
         self.jobs = weakref.WeakValueDictionary()
         
-        self.extranonce_counter = ExtranonceCounter(instance_id)
+        self.extranonce_counter = ExtranonceCounter(instance_id, settings.EXTRANONCE_INSTANCE_BITS,
+                                                    settings.EXTRANONCE_QUARANTINE)
         self.extranonce2_size = block_template_class.coinbase_transaction_class.extranonce_size \
                 - self.extranonce_counter.get_size()
 
         self.coinbaser = coinbaser
         self.block_template_class = block_template_class
         self.bitcoin_rpc = bitcoin_rpc
+        self.tx_cache = TxCache()
+        self.merkle_cache = merkletree.PairHashCache(settings.MERKLE_CACHE_SIZE)
         self.on_block_callback = on_block_callback
         self.on_template_callback = on_template_callback
+
+        if share_hasher == None:
+            share_hasher = ShareHasher('inline')
+        self.share_hasher = share_hasher
         
         self.last_block = None
+        self.last_data = None # getblocktemplate result of last_block
         self.update_in_progress = False
         self.last_update = None
         self.last_update_force = None
+
+        # Exact share targets, keyed by difficulty
+        self.targets = {}
+        self.get_target(settings.POOL_TARGET)
         
         # Create first block template on startup
         self.update_block()
@@ -61,6 +86,10 @@ class TemplateRegistry(object):
         subscribed connection.'''
         log.debug("Getting Unique Extranonce")
         return self.extranonce_counter.get_new_bin()
+
+    def release_extranonce1(self, extranonce1):
+        '''Extranonce1 of closed connection can be reused after the quarantine.'''
+        self.extranonce_counter.release(extranonce1)
     
     def get_last_broadcast_args(self):
         '''Returns arguments for mining.notify
@@ -80,6 +109,7 @@ class TemplateRegistry(object):
         if Interfaces.timestamper.time() - self.last_update_force >= settings.FORCE_REFRESH_INTERVAL:
             log.info("FORCED UPDATE!")
             new_block = True
+            self._drop_templates(self.prevhashes.get(prevhash, []))
             self.prevhashes[prevhash] = []
             self.last_update_force = Interfaces.timestamper.time()
         elif prevhash in self.prevhashes.keys():
@@ -102,6 +132,7 @@ class TemplateRegistry(object):
         # Drop templates of obsolete blocks
         for ph in self.prevhashes.keys():
             if ph != prevhash:
+                self._drop_templates(self.prevhashes[ph])
                 del self.prevhashes[ph]
                 
         log.info("New template for %s" % prevhash)
@@ -114,9 +145,19 @@ class TemplateRegistry(object):
         # Everything is ready, let's broadcast jobs!
         self.on_template_callback(new_block) 
               
-    def update_block(self):
+    def _drop_templates(self, blocks):
+        '''Frees memory of templates which won't be used anymore.
+        Templates may live a bit longer in self.jobs (weak references),
+        but get_job won't return them.'''
+        for block in blocks:
+            block.submits.clear()
+
+    def update_block(self, template=None):
         '''Registry calls the getblocktemplate() RPC
-        and build new block template.'''
+        and build new block template. Result of getblocktemplate
+        can be passed in when the caller already has it.
+        Returns Deferred firing once the template is ready,
+        or None when an update is already in progress.'''
         
         if self.update_in_progress:
             # Block has been already detected
@@ -125,24 +166,64 @@ class TemplateRegistry(object):
         self.update_in_progress = True
         self.last_update = Interfaces.timestamper.time()
         
-        d = self.bitcoin_rpc.getblocktemplate()
+        if template != None:
+            d = defer.succeed(template)
+        else:
+            d = self.bitcoin_rpc.getblocktemplate(raw=True)
+        d.addCallback(self._build_template, JobIdGenerator.get_new_id(), time.time())
         d.addCallback(self._update_block)
         d.addErrback(self._update_block_failed)
+        return d
         
     def _update_block_failed(self, failure):
         log.error(str(failure))
         self.update_in_progress = False
-        
-    def _update_block(self, data):
-        start = Interfaces.timestamper.time()
-                
-        template = self.block_template_class(Interfaces.timestamper, self.coinbaser, JobIdGenerator.get_new_id())
+
+    def _build_template(self, data, job_id, start):
+        rpc_time = time.time() - start
+        if settings.TEMPLATE_BUILD_IN_THREAD:
+            # Only one template is built at a time (update_in_progress),
+            # so tx_cache and merkle_cache are never used by two threads.
+            # Coinbaser may validate its address over RPC, so it is asked here.
+            coinbaser = ResolvedCoinbaser(self.coinbaser)
+            return threads.deferToThread(self._build, data, job_id, coinbaser, rpc_time, time.time())
+        return self._build(data, job_id, self.coinbaser, rpc_time, time.time())
+
+    def _build(self, data, job_id, coinbaser, rpc_time, queued):
+        '''Decodes getblocktemplate result and fills new template.
+        Runs in worker thread, must not touch the reactor.'''
+        start = time.time()
+        if isinstance(data, basestring):
+            data = json.loads(data)['result']
+        decoded = time.time()
+
+        template = self.block_template_class(Interfaces.timestamper, coinbaser, job_id,
+                                             self.tx_cache, self.merkle_cache)
         template.fill_from_rpc(data)
-        #log.info("%s\n", repr(template))
+        filled = time.time()
+
+        return (template, data, {
+            'rpc': rpc_time,
+            'queue': start - queued,
+            'decode': decoded - start,
+            'fill': filled - decoded - template.merkle_time,
+            'merkle': template.merkle_time,
+        })
+        
+    def _update_block(self, result):
+        (template, data, timings) = result
+
+        start = time.time()
+        self.last_data = data
         self.add_template(template)
+        timings['add'] = time.time() - start
+
+        for (phase, seconds) in timings.items():
+            submit_stats.record('template_%s' % phase, seconds)
 
-        log.info("Update finished, %.03f sec, %d txes" % \
-                    (Interfaces.timestamper.time() - start, len(template.vtx)))
+        log.info("Update finished, %.03f sec, %d txes (%s)" % (sum(timings.values()), template.tx_count,
+                 ', '.join([ "%s %.03f" % (phase, timings[phase])
+                             for phase in ('rpc', 'queue', 'decode', 'fill', 'merkle', 'add') ])))
         
         self.update_in_progress = False        
         return data
@@ -175,99 +256,119 @@ class TemplateRegistry(object):
 
     def diff_to_target(self, difficulty):
         '''Converts difficulty to target'''
-        diff1 = 0x000000ffff000000000000000000000000000000000000000000000000000000000000000000000
-        return float(diff1 * 16) / float(difficulty)
-        
-    def submit_share(self, job_id, worker_name, session, extranonce1_bin, extranonce2, ntime, nonce,
-                     difficulty):
+        return float(DIFF1_TARGET) / float(difficulty)
+
+    def get_target(self, difficulty):
+        '''Returns (target, target_bin) for given difficulty. Target is exact
+        integer, target_bin is its 40 bytes long big-endian form, which can
+        be compared directly with reversed PoW hash. Targets are cached,
+        vardiff uses just a handful of difficulties.'''
+        try:
+            return self.targets[difficulty]
+        except KeyError:
+            pass
 
-        # Check for job
+        if len(self.targets) > 1000:
+            # Float vardiff may produce endless list of difficulties
+            self.targets = {}
+
+        d = fractions.Fraction(difficulty)
+        target = min(DIFF1_TARGET * d.denominator // d.numerator, MAX_TARGET)
+        self.targets[difficulty] = (target, binascii.unhexlify("%080x" % target))
+        return self.targets[difficulty]
+        
+    def parse_submit(self, worker_name, job_id, extranonce1_bin, extranonce2, ntime, nonce):
+        '''Builds SubmitRequest out of mining.submit parameters.
+        Stale jobs are refused first, then sizes and charset
+        of all fields are checked before anything is decoded.'''
+        start = time.time()
         job = self.get_job(job_id)
+        submit_stats.record('job_lookup', time.time() - start)
         if job == None:
             raise SubmitException("Job '%s' not found" % job_id)
 
-        nonce = util.rev(nonce)
-        ntime = util.rev(ntime)
-        extranonce2_bin = binascii.unhexlify(extranonce2)
-        ntime_bin = binascii.unhexlify(ntime)
-        nonce_bin = binascii.unhexlify(nonce)
-        
-        # Check if extranonce2 looks correctly. extranonce2 is in hex form...
-        if len(extranonce2) != self.extranonce2_size * 2:
-            raise SubmitException("Incorrect size of extranonce2. Expected %d chars" % (self.extranonce2_size*2))
-                
-        # Check if ntime looks correct
-        if len(ntime) != 8:
-            raise SubmitException("Incorrect size of ntime. Expected 8 chars")
+        return SubmitRequest(worker_name, job, extranonce1_bin, extranonce2, ntime, nonce, self.extranonce2_size)
+
+    def submit_share(self, request, difficulty):
+        '''Checks the share and returns Deferred firing with (block_hash_hex, share_diff, on_submit).
+        Cheap checks are done right away on the reactor thread, hashing
+        is done by share_hasher.'''
+        start = time.time()
+        job = request.job
 
-        if not job.check_ntime(int(ntime, 16)):
+        if not job.check_ntime(request.ntime):
             raise SubmitException("Ntime out of range")
         
-        # Check nonce        
-        if len(nonce) != 8:
-             raise SubmitException("Incorrect size of nonce. Expected 8 chars")
-        
         # Check for duplicated submit
-        if not job.register_submit(extranonce1_bin, extranonce2, ntime, nonce):
-            log.info("Duplicate from %s, (%s %s %s %s)" % \
-                    (worker_name, binascii.hexlify(extranonce1_bin), extranonce2, ntime, nonce))
+        if not job.register_submit(request.extranonce1_bin, request.extranonce2_bin, request.ntime_bin, request.nonce_bin):
+            log.info("Duplicate from %s, (%s %s %s %s)" % (request.worker_name,
+                    binascii.hexlify(request.extranonce1_bin), binascii.hexlify(request.extranonce2_bin),
+                    binascii.hexlify(request.ntime_bin), binascii.hexlify(request.nonce_bin)))
             raise SubmitException("Duplicate share")
         
         # 1. Build coinbase
-        coinbase_bin = job.serialize_coinbase(extranonce1_bin, extranonce2_bin)
-        coinbase_hash = kshake320_hash.getHash320(coinbase_bin)
-        
-        # 2. Calculate merkle root
-        merkle_root_bin = job.merkletree.withFirst(coinbase_hash)
-        merkle_root_int = util.uint320_from_str(merkle_root_bin)
-                
-        # 3. Serialize header with given merkle, ntime and nonce 
-        header_bin = job.serialize_header(merkle_root_bin, int(ntime, 16), int(nonce, 16))
+        coinbase_bin = job.serialize_coinbase(request.extranonce1_bin, request.extranonce2_bin)
 
-        header_hex = binascii.hexlify(header_bin)
-        header_hex = header_hex+"0000000000000000"
-    
-        # 4. Reverse header and compare it with target of the user
-        hash_bin = kshake320_hash.getPoWHash(header_bin)
-        hash_int = util.uint320_from_str(hash_bin)
-        hash_hex = "%080x" % hash_int
-        block_hash_hex = hash_bin[::-1].encode('hex_codec')
-
-        target_user = float(self.diff_to_target(difficulty))
-	if hash_int > target_user:
+        # 2. Serialize header with given ntime and nonce, merkle root is filled by the hasher
+        (header_head, header_tail) = job.serialize_header_parts(request.ntime_bin, request.nonce_bin)
+
+        # 3. Calculate merkle root and PoW hash out of the reactor thread
+        now = time.time()
+        submit_stats.record('checks', now - start)
+        d = self.share_hasher.hash_share(coinbase_bin, job.merkletree._steps, header_head, header_tail)
+        d.addCallback(self._check_share_hash, request, difficulty, now)
+        return d
+
+    def _check_share_hash(self, hashes, request, difficulty, hashing_start):
+        (merkle_root_bin, header_bin, hash_bin, (merkle_time, pow_time)) = hashes
+        submit_stats.record('merkle', merkle_time)
+        submit_stats.record('pow', pow_time)
+        submit_stats.record('hashing_wait', time.time() - hashing_start - merkle_time - pow_time)
+        job = request.job
+
+        # 4. Reverse header and compare it with target of the user.
+        # Big-endian strings of the same length compare like the numbers,
+        # most of the shares are rejected on the first few bytes.
+        hash_be = hash_bin[::-1]
+        if hash_be > self.get_target(difficulty)[1]:
             log.info("ABOVE TARGET!")
             raise SubmitException("Share above target")
 
-        target_info = self.diff_to_target(50)
-        if hash_int <= target_info:
+        if hash_be <= self.get_target(50)[1]:
             log.info("YAY, share with diff above 50")
 
+        block_hash_hex = binascii.hexlify(hash_be)
+
         # Algebra tells us the diff_to_target is the same as hash_to_diff
-        share_diff = float(self.diff_to_target(hash_int))
+        share_diff = float(self.diff_to_target(int(block_hash_hex, 16)))
         
-        if hash_int <= job.target:
+        if hash_be <= job.target_bin:
             # Yay! It is block candidate! 
             log.info("BLOCK CANDIDATE! %s" % block_hash_hex)
 
-            # Finalize and serialize block object 
-            job.finalize(merkle_root_int, extranonce1_bin, extranonce2_bin, int(ntime, 16), int(nonce, 16))
+            header_hex = binascii.hexlify(header_bin) + "0000000000000000"
 
-            if not job.is_valid():
-                # Should not happen
-                log.info("FINAL JOB VALIDATION FAILED!")
-                            
-            # Submit block to the network
-            '''serialized = binascii.hexlify(job.serialize())
-            on_submit = self.bitcoin_rpc.submitblock(str(serialized), block_hash_hex)'''
+            # Submit block to the network first, only the coinbase has to be serialized
+            txs = job.serialize_txs(request.extranonce1_bin, request.extranonce2_bin)
+            on_submit = self.bitcoin_rpc.submitblock_wtxs(str(header_hex), txs, block_hash_hex)
 
-            job.vtx[0].set_extranonce(extranonce1_bin + extranonce2_bin) 
-            txs = binascii.hexlify(util.ser_vector(job.vtx))
-            on_submit = self.bitcoin_rpc.submitblock_wtxs(str(header_hex), str(txs), block_hash_hex)
-            '''if on_submit:
-                self.update_block()'''
+            # Full self-validation is slow, it is done once the block is out
+            merkle_root_int = util.uint320_from_str(merkle_root_bin)
+            on_submit.addBoth(self._validate_block, job, request, merkle_root_int)
 
             return (block_hash_hex, share_diff, on_submit)
         
         return (block_hash_hex, share_diff, None)
 
+    def _validate_block(self, result, job, request, merkle_root_int):
+        '''Finalizes the block object and checks it, passes result of submitblock through'''
+        job.finalize(merkle_root_int, request.extranonce1_bin, request.extranonce2_bin, request.ntime, request.nonce)
+
+        try:
+            if not job.is_valid():
+                # Should not happen
+                log.info("FINAL JOB VALIDATION FAILED!")
+        except Exception:
+            log.exception("Final job validation crashed")
 
+        return result
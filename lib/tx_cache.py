@@ -0,0 +1,62 @@
+import StringIO
+import binascii
+
+import util
+import halfnode
+
+import lib.logger
+log = lib.logger.get_logger('tx_cache')
+
+class CachedTx(object):
+    '''Transaction of getblocktemplate as the pool needs it most of the time:
+    binary txid for the merkle tree and hex data for submitblock.
+    CTransaction object is only built when something asks for it.'''
+
+    __slots__ = ('hash_bin', 'data_hex', '_tx')
+
+    def __init__(self, hash_bin, data_hex):
+        self.hash_bin = hash_bin
+        self.data_hex = data_hex
+        self._tx = None
+
+    @property
+    def tx(self):
+        if self._tx == None:
+            tx = halfnode.CTransaction()
+            tx.deserialize(StringIO.StringIO(binascii.unhexlify(self.data_hex)))
+            self._tx = tx
+        return self._tx
+
+class TxCache(object):
+    '''Transactions of the last getblocktemplate keyed by txid.
+
+    Refreshed template only converts transactions which are new in the
+    mempool, and all templates of the registry share the same objects.
+    Transactions missing in the last getblocktemplate are evicted.'''
+
+    def __init__(self):
+        self.txs = {}
+        self.hits = 0
+        self.misses = 0
+
+    def update(self, transactions):
+        '''Returns list of CachedTx for transactions
+        of getblocktemplate result, in the same order'''
+        (old, self.txs) = (self.txs, {})
+        (hits, result) = (0, [])
+
+        for t in transactions:
+            txid = t['hash']
+            entry = old.get(txid)
+            if entry == None:
+                entry = CachedTx(util.ser_uint320(int(txid, 16)), str(t['data']))
+            else:
+                hits += 1
+
+            self.txs[txid] = entry
+            result.append(entry)
+
+        self.hits += hits
+        self.misses += len(result) - hits
+        log.debug("%d transactions, %d cached, %d evicted" % (len(result), hits, len(old) - hits))
+        return result
@@ -27,61 +27,51 @@ def ser_string(s):
         return chr(254) + struct.pack("<I", len(s)) + s
     return chr(255) + struct.pack("<Q", len(s)) + s
 
+# Big integers are converted in a single pass through their hex
+# representation instead of looping over 32-bit words.
+
+MASK256 = 2**256 - 1
+MASK320 = 2**320 - 1
+
+def _read_exact(f, size):
+    s = f.read(size)
+    if len(s) != size:
+        raise struct.error("unpack requires a string argument of length %d" % size)
+    return s
+
+def _check_size(s, size):
+    if len(s) < size:
+        raise struct.error("unpack requires a string argument of length %d" % size)
+
 def deser_uint256(f):
-    r = 0L
-    for i in xrange(8):
-        t = struct.unpack("<I", f.read(4))[0]
-        r += t << (i * 32)
-    return r
+    return long(binascii.hexlify(_read_exact(f, 32)[::-1]), 16)
 
 def ser_uint256(u):
-    rs = ""
-    for i in xrange(8):
-        rs += struct.pack("<I", u & 0xFFFFFFFFL)
-        u >>= 32
-    return rs
+    return binascii.unhexlify("%064x" % (u & MASK256))[::-1]
 
 def deser_uint320(f):
-    r = 0L
-    for i in xrange(10):
-        t = struct.unpack("<I", f.read(4))[0]
-        r += t << (i * 32)
-    return r
+    return long(binascii.hexlify(_read_exact(f, 40)[::-1]), 16)
 
 def ser_uint320(u):
-    rs = ""
-    for i in xrange(10):
-        rs += struct.pack("<I", u & 0xFFFFFFFFL)
-        u >>= 32
-    return rs
+    return binascii.unhexlify("%080x" % (u & MASK320))[::-1]
 
 def uint256_from_str(s):
-    r = 0L
-    t = struct.unpack("<IIIIIIII", s[:32])
-    for i in xrange(8):
-        r += t[i] << (i * 32)
-    return r
+    _check_size(s, 32)
+    return long(binascii.hexlify(s[31::-1]), 16)
 
 def uint256_from_str_be(s):
-    r = 0L
-    t = struct.unpack(">IIIIIIII", s[:32])
-    for i in xrange(8):
-        r += t[i] << (i * 32)
-    return r
+    # Big-endian 32-bit words, least significant word first
+    _check_size(s, 32)
+    return long(binascii.hexlify(struct.pack(">8I", *struct.unpack("<8I", s[31::-1]))), 16)
 
 def uint320_from_str(s):
-    r = 0L
-    t = struct.unpack("<IIIIIIIIII", s[:40])
-    for i in xrange(10):
-        r += t[i] << (i * 32)
-    return r
+    _check_size(s, 40)
+    return long(binascii.hexlify(s[39::-1]), 16)
 
 def uint320_from_str_be(s):
-    r = 0L
-    t = struct.unpack(">IIIIIIIIII", s[:40])
-    for i in xrange(10):
-        r += t[i] << (i * 32)
-    return r
+    # Big-endian 32-bit words, least significant word first
+    _check_size(s, 40)
+    return long(binascii.hexlify(struct.pack(">10I", *struct.unpack("<10I", s[39::-1]))), 16)
 
 def uint320_from_compact(c):
     nbytes = (c >> 24) & 0xFF
@@ -114,19 +104,17 @@ def deser_vector(f, c):
         r.append(t)
     return r
 
+def ser_compact_size(n):
+    if n < 253:
+        return chr(n)
+    elif n < 0x10000:
+        return chr(253) + struct.pack("<H", n)
+    elif n < 0x100000000L:
+        return chr(254) + struct.pack("<I", n)
+    return chr(255) + struct.pack("<Q", n)
+
 def ser_vector(l):
-    r = ""
-    if len(l) < 253:
-        r = chr(len(l))
-    elif len(l) < 0x10000:
-        r = chr(253) + struct.pack("<H", len(l))
-    elif len(l) < 0x100000000L:
-        r = chr(254) + struct.pack("<I", len(l))
-    else:
-        r = chr(255) + struct.pack("<Q", len(l))
-    for i in l:
-        r += i.serialize()
-    return r
+    return ser_compact_size(len(l)) + "".join([ i.serialize() for i in l ])
 
 def deser_uint256_vector(f):
     nit = struct.unpack("<B", f.read(1))[0]
@@ -280,33 +268,19 @@ def address_to_pubkeyhash(addr):
 
 def ser_uint256_be(u):
     '''ser_uint256 to big endian'''
-    rs = ""
-    for i in xrange(8):
-        rs += struct.pack(">I", u & 0xFFFFFFFFL)
-        u >>= 32
-    return rs    
+    return struct.pack(">8I", *struct.unpack("<8I", ser_uint256(u)))
 
 def deser_uint320_be(f):
-    r = 0L
-    for i in xrange(8):
-        t = struct.unpack(">I", f.read(4))[0]
-        r += t << (i * 32)
-    return r
+    # Reads just 8 words, kept for compatibility
+    return uint256_from_str_be(_read_exact(f, 32))
 
 def ser_uint320_be(u):
     '''ser_uint256 to big endian'''
-    rs = ""
-    for i in xrange(10):
-        rs += struct.pack(">I", u & 0xFFFFFFFFL)
-        u >>= 32
-    return rs    
+    return struct.pack(">10I", *struct.unpack("<10I", ser_uint320(u)))
 
 def deser_uint256_be(f):
-    r = 0L
-    for i in xrange(10):
-        t = struct.unpack(">I", f.read(4))[0]
-        r += t << (i * 32)
-    return r
+    # Reads 10 words, kept for compatibility
+    return uint320_from_str_be(_read_exact(f, 40))
 
 def ser_number(n):
     # For encoding nHeight into coinbase
@@ -5,6 +5,7 @@ import Queue
 import signal
 
 import lib.settings as settings
+from lib.expiry import expiry
 import DB_Mysql
 
 import lib.logger
@@ -19,7 +20,7 @@ class DBInterface():
         self.q = Queue.Queue()
         self.queueclock = None
         self.usercache = {}
-        self.clearusercache()
+        self.usercache_expiry = expiry.register('auth_cache', self._expire_user)
         self.nextStatsUpdate = 0
         self.scheduleImport()        
         self.next_force_import_time = time.time() + settings.DB_LOADER_FORCE_TIME    
@@ -40,7 +41,15 @@ class DBInterface():
     def clearusercache(self):
         log.debug("DBInterface.clearusercache called")
         self.usercache = {}
-        self.usercacheclock = reactor.callLater(settings.DB_USERCACHE_TIME , self.clearusercache)
+        self.usercache_expiry.clear()
+
+    def cache_user(self, wid):
+        # Password is checked again after DB_USERCACHE_TIME
+        self.usercache[wid] = 1
+        self.usercache_expiry.add(wid, settings.DB_USERCACHE_TIME)
+
+    def _expire_user(self, wid):
+        self.usercache.pop(wid, None)
 
     def scheduleImport(self):
         # This schedule's the Import
@@ -123,14 +132,14 @@ class DBInterface():
         if wid in self.usercache:
             return True
         elif not settings.USERS_CHECK_PASSWORD and self.user_exists(username): 
-            self.usercache[wid] = 1
+            self.cache_user(wid)
             return True
         elif self.dbi.check_password(username, password):
-            self.usercache[wid] = 1
+            self.cache_user(wid)
             return True
         elif settings.USERS_AUTOADD == True:
             self.insert_user(username, password)
-            self.usercache[wid] = 1
+            self.cache_user(wid)
             return True
         
         log.info("Authentication for %s failed" % username)
@@ -150,11 +159,11 @@ class DBInterface():
         return self.dbi.insert_user(username, password)
 
     def delete_user(self, username):
-        self.usercache = {}
+        self.clearusercache()
         return self.dbi.delete_user(username)
         
     def update_user(self, username, password):
-        self.usercache = {}
+        self.clearusercache()
         return self.dbi.update_user(username, password)
 
     def update_worker_diff(self, username, diff):
@@ -5,8 +5,6 @@ from twisted.internet.error import ConnectionRefusedError
 import time
 import simplejson as json
 from twisted.internet import reactor
-import threading
-from mining.work_log_pruner import WorkLogPruner
 
 @defer.inlineCallbacks
 def setup(on_startup):
@@ -29,11 +27,40 @@ def setup(on_startup):
     from lib.bitcoin_rpc import BitcoinRPC
     from lib.block_template import BlockTemplate
     from lib.coinbaser import SimpleCoinbaser
+    from lib.share_hasher import ShareHasher
+    import mining.supervisor as supervisor
 
-    bitcoin_rpc = BitcoinRPC(settings.DAEMON_TRUSTED_HOST,
-                             settings.DAEMON_TRUSTED_PORT,
-                             settings.DAEMON_TRUSTED_USER,
-                             settings.DAEMON_TRUSTED_PASSWORD)
+    frontend_id = supervisor.get_frontend_id()
+
+    # Start share hashing workers before the reactor is busy,
+    # worker processes are forked from this process.
+    if frontend_id != None:
+        share_hasher = ShareHasher(settings.FRONTEND_SHARE_HASHING_MODE, settings.SHARE_HASHING_WORKERS)
+    else:
+        share_hasher = ShareHasher(settings.SHARE_HASHING_MODE, settings.SHARE_HASHING_WORKERS)
+
+    if frontend_id != None:
+        # Coin daemon is called by the supervisor, which also records the shares
+        log.info("Front-end %d connecting to supervisor %s" % (frontend_id, supervisor.get_supervisor_socket()))
+        bitcoin_rpc = (yield supervisor.SupervisorClient(supervisor.get_supervisor_socket()).connect())
+        settings.INSTANCE_ID = frontend_id
+        Interfaces.set_share_manager(supervisor.FrontendShareManager(bitcoin_rpc))
+    else:
+        bitcoin_rpc = BitcoinRPC(settings.DAEMON_TRUSTED_HOST,
+                                 settings.DAEMON_TRUSTED_PORT,
+                                 settings.DAEMON_TRUSTED_USER,
+                                 settings.DAEMON_TRUSTED_PASSWORD,
+                                 settings.DAEMON_RPC_POOL_SIZE,
+                                 settings.DAEMON_RPC_TIMEOUT,
+                                 settings.DAEMON_RPC_IDLE_TIMEOUT)
+
+    if settings.DAEMON_TRUSTED_EXTRA and frontend_id == None:
+        from lib.daemon_group import DaemonGroup
+        bitcoin_rpc = DaemonGroup([bitcoin_rpc] + [ BitcoinRPC(host, port, user, password,
+                                                               settings.DAEMON_RPC_POOL_SIZE,
+                                                               settings.DAEMON_RPC_TIMEOUT,
+                                                               settings.DAEMON_RPC_IDLE_TIMEOUT)
+                                                    for (host, port, user, password) in settings.DAEMON_TRUSTED_EXTRA ])
 
     log.info("Connecting to RPC...")
 
@@ -52,26 +79,65 @@ def setup(on_startup):
     coinbaser = SimpleCoinbaser(bitcoin_rpc, getattr(settings, 'CENTRAL_WALLET'))
     (yield coinbaser.on_load)
     
+    on_template = MiningSubscription.on_template
+    if settings.FRONTEND_PROCESSES and frontend_id == None:
+        # Front-ends get every template the supervisor gets
+        supervisor_factory = supervisor.Supervisor(bitcoin_rpc, on_template)
+        on_template = supervisor_factory.on_template
+
     registry = TemplateRegistry(BlockTemplate,
                                 coinbaser,
                                 bitcoin_rpc,
                                 getattr(settings, 'INSTANCE_ID'),
-                                MiningSubscription.on_template,
-                                Interfaces.share_manager.on_network_block)
-    
-    # Template registry is the main interface between Stratum service
-    # and pool core logic
-    Interfaces.set_template_registry(registry)
-    
-    # Set up polling mechanism for detecting new block on the network
-    # This is just failsafe solution when -blocknotify
-    # mechanism is not working properly    
-    BlockUpdater(registry, bitcoin_rpc)
-
-    prune_thr = threading.Thread(target=WorkLogPruner, args=(Interfaces.worker_manager.job_log,))
-    prune_thr.daemon = True
-    prune_thr.start()
+                                on_template,
+                                Interfaces.share_manager.on_network_block,
+                                share_hasher)
+
+    if frontend_id != None:
+        # Pool info is updated by the supervisor
+        Interfaces.template_registry = registry
+        bitcoin_rpc.set_registry(registry)
+
+        # Stratum framework must not bind ports, the socket transport
+        # port is shared by the front-ends
+        from stratum import settings as stratum_settings
+        from stratum.services import ServiceEventHandler
+        from stratum import socket_transport
+        for name in ('LISTEN_SOCKET_TRANSPORT', 'LISTEN_HTTP_TRANSPORT', 'LISTEN_HTTPS_TRANSPORT',
+                     'LISTEN_WS_TRANSPORT', 'LISTEN_WSS_TRANSPORT'):
+            setattr(stratum_settings, name, None)
+        supervisor.listen_reuseport(settings.LISTEN_SOCKET_TRANSPORT,
+                socket_transport.SocketTransportFactory(debug=settings.DEBUG,
+                                                        signing_id=settings.SIGNING_ID,
+                                                        event_handler=ServiceEventHandler,
+                                                        tcp_proxy_protocol_enable=settings.TCP_PROXY_PROTOCOL))
+        log.info("Front-end %d listening on port %d" % (frontend_id, settings.LISTEN_SOCKET_TRANSPORT))
+    else:
+        # Template registry is the main interface between Stratum service
+        # and pool core logic
+        Interfaces.set_template_registry(registry)
     
+        # Set up polling mechanism for detecting new block on the network
+        # This is just failsafe solution when -blocknotify
+        # mechanism is not working properly    
+        BlockUpdater(registry, bitcoin_rpc)
+
+        if settings.BLOCKNOTIFY_LISTEN:
+            # Datagram endpoint for -blocknotify of the coin daemon
+            import lib.block_notify
+            Interfaces.set_block_notify(lib.block_notify.listen(registry, settings.BLOCKNOTIFY_SECRET,
+                                                                settings.BLOCKNOTIFY_LISTEN))
+
+        if settings.FRONTEND_PROCESSES:
+            # Miners connect to the front-ends
+            from stratum import settings as stratum_settings
+            stratum_settings.LISTEN_SOCKET_TRANSPORT = None
+            supervisor_factory.start(registry, settings.SUPERVISOR_SOCKET, settings.FRONTEND_PROCESSES)
+
+    # Expires idle entries of worker stats, auth cache and vardiff
+    from lib.expiry import expiry
+    expiry.start()
+
     log.info("MINING SERVICE IS READY")
     on_startup.callback(True)
 
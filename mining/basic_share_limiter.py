@@ -9,6 +9,7 @@ dbi = DBInterface.DBInterface()
 
 from twisted.internet import defer
 from mining.interfaces import Interfaces
+from lib.expiry import expiry
 import time
 
 ''' This is just a customized ring buffer '''
@@ -69,10 +70,15 @@ class BasicShareLimiter(object):
         self.tmin = self.target - self.variance
         self.tmax = self.target + self.variance
         self.buffersize = self.retarget / self.target * 4
-        # TODO: trim the hash of inactive workers
+        self.worker_stats_expiry = expiry.register('vardiff', self._expire_worker)
+
+    def _expire_worker(self, extranonce1_bin):
+        self.worker_stats.pop(extranonce1_bin, None)
 
     def submit(self, connection_ref, job_id, current_difficulty, timestamp, worker_name, extranonce1_bin):
         ts = int(timestamp)
+        # Stats older than this would be reset below anyway
+        self.worker_stats_expiry.touch(extranonce1_bin, settings.DB_USERCACHE_TIME)
 
         # Init the stats for this worker if it isn't set.        
         if extranonce1_bin not in self.worker_stats or self.worker_stats[extranonce1_bin]['last_ts'] < ts - settings.DB_USERCACHE_TIME :
@@ -151,13 +157,24 @@ class BasicShareLimiter(object):
 
         (job_id, prevhash, coinb1, coinb2, merkle_branch, version, nbits, ntime, nTxTime, _) = \
             Interfaces.template_registry.get_last_broadcast_args()
-        work_id = Interfaces.worker_manager.register_work(extranonce1_bin, job_id, new_diff)
+        if 'jobs' in session:
+            work_id = session['jobs'].add(job_id, new_diff)
+        else:
+            work_id = job_id
         
+        # Precompute the share target before the first share on new difficulty arrives
+        Interfaces.template_registry.get_target(new_diff)
         session['difficulty'] = new_diff
-        if job_id == '00':
-            connection_ref().rpc('mining.set_difficulty', [0,], is_notification=True)
+        consumer = session.get('consumer')
+        if consumer != None and consumer.paused:
+            # Sent when the connection catches up, unless a newer job comes first
+            consumer.send_job(Interfaces.template_registry.last_block, work_id, False,
+                              0 if job_id == '00' else new_diff, None)
         else:
-            connection_ref().rpc('mining.set_difficulty', [new_diff,], is_notification=True)
-        connection_ref().rpc('mining.notify', [work_id, prevhash, coinb1, coinb2, merkle_branch, version, nbits, ntime, nTxTime, False,], is_notification=True)
+            if job_id == '00':
+                connection_ref().rpc('mining.set_difficulty', [0,], is_notification=True)
+            else:
+                connection_ref().rpc('mining.set_difficulty', [new_diff,], is_notification=True)
+            connection_ref().rpc('mining.notify', [work_id, prevhash, coinb1, coinb2, merkle_branch, version, nbits, ntime, nTxTime, False,], is_notification=True)
         dbi.update_worker_diff(worker_name, new_diff)
 
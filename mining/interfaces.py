@@ -6,6 +6,7 @@
 import time
 from twisted.internet import reactor, defer
 from lib.util import b58encode
+from lib.expiry import expiry
 
 import lib.settings as settings
 import lib.logger
@@ -19,9 +20,15 @@ class WorkerManagerInterface(object):
     def __init__(self):
         self.worker_log = {}
         self.worker_log.setdefault('authorized', {})
-        self.job_log = {}
-        self.job_log.setdefault('None', {})
+        self.worker_log_expiry = expiry.register('worker_log', self._expire_worker_log)
         return
+
+    def _expire_worker_log(self, extranonce1):
+        self.worker_log['authorized'].pop(extranonce1, None)
+
+    def touch_worker_log(self, extranonce1):
+        '''Keeps worker stats of the connection while it submits shares'''
+        self.worker_log_expiry.touch(extranonce1, settings.WORKER_CACHE_TIME + settings.WORKER_BAN_TIME)
         
     def authorize(self, worker_name, worker_password):
         # Important NOTE: This is called on EVERY submitted share. So you'll need caching!!!
@@ -30,22 +37,6 @@ class WorkerManagerInterface(object):
     def update_worker_diff(self, worker_name, diff):
         return dbi.update_worker_diff(worker_name, diff)
 
-    def register_work(self, extranonce1, job_id, difficulty):
-        now = Interfaces.timestamper.time()
-        work_id = WorkIdGenerator.get_new_id()
-        self.job_log.setdefault(extranonce1, {})[work_id] = (job_id, difficulty, now)
-        return work_id
-
-class WorkIdGenerator(object):
-    counter = 1000
-    
-    @classmethod
-    def get_new_id(cls):
-        cls.counter += 1
-        if cls.counter % 0xffff == 0:
-            cls.counter = 1
-        return "%x" % cls.counter
-
 class ShareLimiterInterface(object):
     '''Implement difficulty adjustments here'''
     
@@ -97,6 +88,7 @@ class Interfaces(object):
     share_limiter = None
     timestamper = None
     template_registry = None
+    block_notify = None
 
     @classmethod
     def set_worker_manager(cls, manager):
@@ -114,6 +106,10 @@ class Interfaces(object):
     def set_timestamper(cls, manager):
         cls.timestamper = manager
         
+    @classmethod
+    def set_block_notify(cls, listener):
+        cls.block_notify = listener
+
     @classmethod
     def set_template_registry(cls, registry):
         dbi.set_bitcoinrpc(registry.bitcoin_rpc)
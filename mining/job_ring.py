@@ -0,0 +1,40 @@
+class JobRing(object):
+    '''Jobs recently sent to one connection, kept in the session.
+
+    Fixed number of slots in parallel lists, the oldest slot is reused
+    by the next job. Broadcasts send the shared job_id; only a job sent
+    again with another difficulty (vardiff retarget) gets its own work id,
+    so the submit resolves to the difficulty the miner worked on.'''
+
+    __slots__ = ('work_ids', 'job_ids', 'difficulties', 'position', 'resent')
+
+    def __init__(self, size):
+        self.work_ids = [None] * size
+        self.job_ids = [None] * size
+        self.difficulties = [None] * size
+        self.position = 0
+        self.resent = 0
+
+    def add(self, job_id, difficulty):
+        '''Registers job sent with given difficulty, returns work id for mining.notify'''
+        work_id = job_id
+        if work_id in self.work_ids:
+            # Not a hex digit, can't be mistaken for another job_id
+            self.resent += 1
+            work_id = '%sr%x' % (job_id, self.resent)
+
+        i = self.position
+        self.work_ids[i] = work_id
+        self.job_ids[i] = job_id
+        self.difficulties[i] = difficulty
+        self.position = (i + 1) % len(self.work_ids)
+        return work_id
+
+    def get(self, work_id):
+        '''Returns (job_id, difficulty) of the work id or None
+        when it is unknown or already overwritten'''
+        try:
+            i = self.work_ids.index(work_id)
+        except ValueError:
+            return None
+        return (self.job_ids[i], self.difficulties[i])
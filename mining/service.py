@@ -1,15 +1,22 @@
 import binascii
 from twisted.internet import defer
+from twisted.python.failure import Failure
 
 import lib.settings as settings
 from stratum.services import GenericService, admin
 from stratum.pubsub import Pubsub
 from interfaces import Interfaces
 from subscription import MiningSubscription
+from job_ring import JobRing
+from slow_consumer import monitor as slow_consumers
+import supervisor
 from lib.exceptions import SubmitException
 import json
 import struct
+import time
 import lib.util as util
+from lib.submit_stats import submit_stats
+from lib.expiry import expiry
 
 import lib.logger
 log = lib.logger.get_logger('mining')
@@ -33,21 +40,85 @@ class MiningService(GenericService):
         See blocknotify.sh in /scripts/ for more info.'''
         
         log.info("NEW BLOCK NOTIFICATION RECEIVED!")
-        Interfaces.template_registry.update_block()
+        if supervisor.get_frontend_id() != None:
+            # Supervisor updates its registry and publishes the template to all front-ends
+            Interfaces.template_registry.bitcoin_rpc.update_block()
+        else:
+            Interfaces.template_registry.update_block()
         return True 
+
+    @admin
+    def get_submit_stats(self):
+        '''Returns latency histograms (in ms) of the stages
+        of mining.submit and counters of reject reasons.'''
+        return submit_stats.get_stats()
+
+    @admin
+    def get_block_notify_stats(self):
+        '''Returns counters of accepted and rejected block notifications,
+        or None when the block notify listener is not running.'''
+        if Interfaces.block_notify == None:
+            return None
+        return Interfaces.block_notify.get_stats()
+
+    @admin
+    def get_expiry_stats(self):
+        '''Returns entry counts and evictions of the expiring caches.'''
+        return expiry.get_stats()
+
+    @admin
+    def get_extranonce_stats(self):
+        '''Returns occupancy and counters of the extranonce1 allocator.'''
+        return Interfaces.template_registry.extranonce_counter.get_stats()
+
+    @admin
+    def get_slow_consumer_stats(self):
+        '''Returns counters of connections with backed up output
+        and of jobs they didn't get.'''
+        return slow_consumers.get_stats()
+
+    @admin
+    def reset_submit_stats(self):
+        '''Resets latency histograms and reject counters.'''
+        submit_stats.reset()
+        return True
+
+    @admin
+    def get_rpc_stats(self):
+        '''Returns counters of coin daemon RPC calls
+        and of reused keep-alive connections.'''
+        return Interfaces.template_registry.bitcoin_rpc.get_stats()
     
     def subscribe(self, *args):
         '''Subscribe for receiving mining jobs. This will
         return subscription details, extranonce1_hex and extranonce2_size'''
         
-        extranonce1 = Interfaces.template_registry.get_new_extranonce1()
-        extranonce2_size = Interfaces.template_registry.extranonce2_size
+        registry = Interfaces.template_registry
+        connection = self.connection_ref()
+        session = connection.get_session()
+        if 'extranonce1' in session:
+            # Subscribed again on the same connection
+            registry.release_extranonce1(session.pop('extranonce1'))
+
+        extranonce1 = registry.get_new_extranonce1()
+        extranonce2_size = registry.extranonce2_size
         extranonce1_hex = binascii.hexlify(extranonce1)
-        
-        session = self.connection_ref().get_session()
+
+        if connection.on_disconnect != None:
+            connection.on_disconnect.addCallback(self._release_extranonce1, extranonce1)
         session['extranonce1'] = extranonce1
         session['difficulty'] = settings.POOL_TARGET
-        return Pubsub.subscribe(self.connection_ref(), MiningSubscription()) + (extranonce1_hex, extranonce2_size)
+        session['jobs'] = JobRing(settings.JOB_RING_SIZE)
+        if 'consumer' not in session:
+            session['consumer'] = slow_consumers.watch(connection)
+        return Pubsub.subscribe(connection, MiningSubscription()) + (extranonce1_hex, extranonce2_size)
+
+    @staticmethod
+    def _release_extranonce1(connection, extranonce1):
+        if connection.get_session().get('extranonce1') == extranonce1:
+            Interfaces.template_registry.release_extranonce1(extranonce1)
+        # Passed on to the other callbacks of on_disconnect
+        return connection
         
     def authorize(self, worker_name, worker_password):
         '''Let authorize worker on this connection.'''
@@ -62,6 +133,7 @@ class MiningService(GenericService):
             Interfaces.worker_manager.update_worker_diff(worker_name, settings.POOL_TARGET)
             if settings.ENABLE_WORKER_STATS:
                 Interfaces.worker_manager.worker_log['authorized'][extranonce1] = (0, 0, False, Interfaces.timestamper.time())
+                Interfaces.worker_manager.touch_worker_log(extranonce1)
             return True
         else:
             ip = self.connection_ref()._get_ip()
@@ -75,13 +147,17 @@ class MiningService(GenericService):
     def submit(self, worker_name, work_id, extranonce2, ntime, nonce):
         '''Try to solve block candidate using given parameters.'''
 
+        start = time.time()
         session = self.connection_ref().get_session()
         session.setdefault('authorized', {})
         
         # Check if worker is authorized to submit shares
         ip = self.connection_ref()._get_ip()
-        if not Interfaces.worker_manager.authorize(worker_name, session['authorized'].get(worker_name)):
+        authorized = Interfaces.worker_manager.authorize(worker_name, session['authorized'].get(worker_name))
+        submit_stats.record('authorize', time.time() - start)
+        if not authorized:
             log.info("Worker is not authorized: %s IP %s" % (worker_name, str(ip)))
+            submit_stats.record_reject("Worker is not authorized")
             raise SubmitException("Worker is not authorized")
 
         # Check if extranonce1 is in connection session
@@ -89,21 +165,33 @@ class MiningService(GenericService):
         
         if not extranonce1_bin:
             log.info("Connection is not subscribed for mining: IP %s" % str(ip))
+            submit_stats.record_reject("Connection is not subscribed for mining")
             raise SubmitException("Connection is not subscribed for mining")
         
         difficulty = session['difficulty']
         submit_time = Interfaces.timestamper.time()
 
-        if extranonce1_bin in Interfaces.worker_manager.job_log and work_id in Interfaces.worker_manager.job_log[extranonce1_bin]:
-            (job_id, difficulty, job_ts) = Interfaces.worker_manager.job_log[extranonce1_bin][work_id]
+        job = session['jobs'].get(work_id) if 'jobs' in session else None
+        if job != None:
+            (job_id, difficulty) = job
         else:
-            job_ts = Interfaces.timestamper.time()
-            Interfaces.worker_manager.job_log.setdefault(extranonce1_bin, {})[work_id] = (work_id, difficulty, job_ts)
+            # Not sent to this connection or too old, registry decides
             job_id = work_id
-        #log.debug("worker_job_log: %s" % repr(Interfaces.worker_manager.job_log))
+
+        # Stale jobs and malformed submits are refused before anything gets decoded.
+        # The rejection is still accounted as invalid share below.
+        try:
+            request = Interfaces.template_registry.parse_submit(worker_name, job_id,
+                    extranonce1_bin, extranonce2, ntime, nonce)
+        except SubmitException:
+            request = None
+            rejected = Failure()
 
         if settings.ENABLE_WORKER_STATS:
-            (valid, invalid, is_banned, last_ts) = Interfaces.worker_manager.worker_log['authorized'][extranonce1_bin]
+            # Stats of workers idle for long have expired
+            (valid, invalid, is_banned, last_ts) = Interfaces.worker_manager.worker_log['authorized'].get(extranonce1_bin,
+                    (0, 0, False, submit_time))
+            Interfaces.worker_manager.touch_worker_log(extranonce1_bin)
             percent = float(float(invalid) / (float(valid) if valid else 1) * 100)
 
             if is_banned and submit_time - last_ts > settings.WORKER_BAN_TIME:
@@ -122,43 +210,100 @@ class MiningService(GenericService):
                     log.debug("Clearing worker stats for: %s" %  worker_name)
                 (valid, invalid, is_banned, last_ts) = (0, 0, is_banned, Interfaces.timestamper.time())
 
+            Interfaces.worker_manager.worker_log['authorized'][extranonce1_bin] = (valid, invalid, is_banned, last_ts)
+
         if settings.ENABLE_WORKER_STATS:
             log.debug("%s (%d, %d, %s, %d) %0.2f%% job_id(%s) diff(%i)" % (worker_name, valid, invalid, is_banned, last_ts, percent, job_id, difficulty))
         
+        vardiff_start = time.time()
         Interfaces.share_limiter.submit(self.connection_ref, job_id, difficulty, submit_time, worker_name, extranonce1_bin)
+        submit_stats.record('vardiff', time.time() - vardiff_start)
 
-        try:
-            (block_hash, share_diff, on_submit) = Interfaces.template_registry.submit_share(job_id,
-                worker_name, session, extranonce1_bin, extranonce2, ntime, nonce, difficulty)
-        except SubmitException as e:
-            # block_header and block_hash are None when submitted data are corrupted
-            if settings.ENABLE_WORKER_STATS:
-                invalid += 1
-                if invalid > settings.INVALID_SHARES_SPAM:
-                    is_banned = True
-                    log.info("Worker SPAM %s BANNED! IP: %s" % (worker_name, ip))
-                Interfaces.worker_manager.worker_log['authorized'][extranonce1_bin] = (valid, invalid, is_banned, last_ts)
+        # Share hashing is done out of the reactor thread, so the result is a Deferred
+        if request == None:
+            d = defer.fail(rejected)
+        else:
+            d = defer.maybeDeferred(Interfaces.template_registry.submit_share, request, difficulty)
+        d.addCallbacks(self._on_valid_share, self._on_invalid_share,
+                callbackArgs=(worker_name, extranonce1_bin, difficulty, submit_time, ip, job_id),
+                errbackArgs=(worker_name, extranonce1_bin, difficulty, submit_time, ip, job_id))
+        d.addBoth(self._record_total, start)
+        return self._answer_in_order(session, d)
 
-                if is_banned:
-                    raise SubmitException("Worker is temporarily banned")
- 
-            Interfaces.share_manager.on_submit_share(worker_name, False, difficulty,
-                submit_time, False, ip, e[0], 0, job_id)  
-            raise
+    def _record_total(self, result, start):
+        submit_stats.record('total', time.time() - start)
+        return result
+
+    def _on_invalid_share(self, failure, worker_name, extranonce1_bin, difficulty, submit_time, ip, job_id):
+        failure.trap(SubmitException)
+        submit_stats.record_reject(failure.value[0])
 
+        # block_header and block_hash are None when submitted data are corrupted
         if settings.ENABLE_WORKER_STATS:
+            # Entry may be gone while the share was hashed (failed authorize, expiry)
+            (valid, invalid, is_banned, last_ts) = Interfaces.worker_manager.worker_log['authorized'].get(extranonce1_bin,
+                    (0, 0, False, submit_time))
+            Interfaces.worker_manager.touch_worker_log(extranonce1_bin)
+            invalid += 1
+            if invalid > settings.INVALID_SHARES_SPAM:
+                is_banned = True
+                log.info("Worker SPAM %s BANNED! IP: %s" % (worker_name, ip))
+            Interfaces.worker_manager.worker_log['authorized'][extranonce1_bin] = (valid, invalid, is_banned, last_ts)
+
+            if is_banned:
+                raise SubmitException("Worker is temporarily banned")
+
+        start = time.time()
+        Interfaces.share_manager.on_submit_share(worker_name, False, difficulty,
+            submit_time, False, ip, failure.value[0], 0, job_id)
+        submit_stats.record('db', time.time() - start)
+        return failure
+
+    def _on_valid_share(self, result, worker_name, extranonce1_bin, difficulty, submit_time, ip, job_id):
+        (block_hash, share_diff, on_submit) = result
+
+        if settings.ENABLE_WORKER_STATS:
+            # Entry may be gone while the share was hashed (failed authorize, expiry)
+            (valid, invalid, is_banned, last_ts) = Interfaces.worker_manager.worker_log['authorized'].get(extranonce1_bin,
+                    (0, 0, False, submit_time))
+            Interfaces.worker_manager.touch_worker_log(extranonce1_bin)
             valid += 1
             Interfaces.worker_manager.worker_log['authorized'][extranonce1_bin] = (valid, invalid, is_banned, last_ts)
 
             if is_banned:
                 raise SubmitException("Worker is temporarily banned")
  
+        start = time.time()
         Interfaces.share_manager.on_submit_share(worker_name,
             block_hash, difficulty, submit_time, True, ip, '', share_diff, job_id)
+        submit_stats.record('db', time.time() - start)
 
         if on_submit != None:
             on_submit.addCallback(Interfaces.share_manager.on_submit_block,
                 worker_name, block_hash, submit_time, ip, share_diff)
 
         return True
+
+    def _answer_in_order(self, session, d):
+        '''Shares are hashed in parallel, but the miner
+        expects answers in the same order as it sent its submits.
+        Returned Deferred fires only after all previous submits
+        of the same connection have been answered.'''
+        previous = session.get('last_submit')
+        done = defer.Deferred()
+        session['last_submit'] = done
+        result = defer.Deferred()
+
+        def _release(r):
+            result.callback(r)
+            done.callback(None)
+
+        def _wait(r):
+            if previous == None:
+                _release(r)
+            else:
+                previous.addCallback(lambda _: _release(r))
+
+        d.addBoth(_wait)
+        return result
         
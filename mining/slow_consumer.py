@@ -0,0 +1,131 @@
+'''Backpressure of miner connections which don't read their jobs.
+
+Every subscribed connection registers a SlowConsumer as push producer
+of its transport. Twisted pauses it once more than SLOW_CONSUMER_BUFFER
+bytes wait in the transport and resumes it when everything is sent.
+Jobs for a paused connection are not written; only the latest one is
+kept and sent on resume. Connections paused for SLOW_CONSUMER_TIMEOUT
+seconds are disconnected. Use MiningService.get_slow_consumer_stats
+admin call to see the counters.
+
+Transport doesn't close the connection on loseConnection while a
+producer is registered, so watched connections are closed by
+SlowConsumer.close.'''
+
+import weakref
+
+from zope.interface import implementer
+from twisted.internet.interfaces import IPushProducer
+
+from mining.subscription import MiningSubscription
+from lib.expiry import expiry
+
+import lib.settings as settings
+import lib.logger
+log = lib.logger.get_logger('slow_consumer')
+
+@implementer(IPushProducer)
+class SlowConsumer(object):
+    '''Output state of one connection, kept in the session'''
+
+    def __init__(self, monitor, connection):
+        self.monitor = monitor
+        self.connection_ref = weakref.ref(connection)
+        self.paused = False
+        # (template, work_id, clean_jobs, difficulty) of the job waiting for resume
+        self.pending = None
+
+    def send_job(self, template, work_id, clean_jobs, difficulty, data):
+        '''Writes the job (data) or keeps it until the connection catches up'''
+        if not self.paused:
+            conn = self.connection_ref()
+            if conn != None:
+                MiningSubscription.write_job(conn, template, work_id, clean_jobs, difficulty, data)
+            return
+
+        if self.pending != None:
+            # Miner must still drop the jobs of the superseded notify
+            self.monitor.coalesced += 1
+            clean_jobs = clean_jobs or self.pending[2]
+        self.pending = (template, work_id, clean_jobs, difficulty)
+
+    def pauseProducing(self):
+        self.paused = True
+        self.monitor.pause(self)
+
+    def resumeProducing(self):
+        self.paused = False
+        self.monitor.resume(self)
+        if self.pending != None:
+            (template, work_id, clean_jobs, difficulty) = self.pending
+            self.pending = None
+            conn = self.connection_ref()
+            if conn != None:
+                MiningSubscription.write_job(conn, template, work_id, clean_jobs, difficulty)
+                self.monitor.flushed += 1
+
+    def stopProducing(self):
+        # Connection is closed
+        self.pending = None
+        self.monitor.resume(self)
+        conn = self.connection_ref()
+        if conn != None and conn.transport != None:
+            conn.transport.unregisterProducer()
+
+    def close(self):
+        '''Closes the connection. Output of a paused one would not
+        be sent in time anyway, so it is dropped.'''
+        conn = self.connection_ref()
+        if conn == None or conn.transport == None:
+            return
+        conn.transport.unregisterProducer()
+        if self.paused:
+            conn.transport.abortConnection()
+        else:
+            conn.transport.loseConnection()
+
+class SlowConsumerMonitor(object):
+    '''Registers SlowConsumers and disconnects connections which stay paused'''
+
+    def __init__(self):
+        self.paused = expiry.register('slow_consumers', self._expire)
+        self.pauses = 0
+        self.coalesced = 0
+        self.flushed = 0
+        self.disconnected = 0
+
+    def watch(self, connection):
+        '''Returns SlowConsumer of the connection or None when its transport can't tell'''
+        transport = connection.transport
+        if transport == None or not hasattr(transport, 'registerProducer'):
+            return None
+        consumer = SlowConsumer(self, connection)
+        transport.bufferSize = settings.SLOW_CONSUMER_BUFFER
+        transport.registerProducer(consumer, True)
+        return consumer
+
+    def pause(self, consumer):
+        self.pauses += 1
+        self.paused.add(consumer, settings.SLOW_CONSUMER_TIMEOUT)
+
+    def resume(self, consumer):
+        self.paused.discard(consumer)
+
+    def _expire(self, consumer):
+        conn = consumer.connection_ref()
+        if conn == None or conn.transport == None:
+            return
+        self.disconnected += 1
+        log.info("Disconnecting %s, output backed up for %d seconds" % (conn._get_ip(), settings.SLOW_CONSUMER_TIMEOUT))
+        consumer.close()
+
+    def get_stats(self):
+        return {
+            'paused': len(self.paused.keys),
+            'pauses': self.pauses,
+            'coalesced': self.coalesced,
+            'flushed': self.flushed,
+            'disconnected': self.disconnected,
+        }
+
+monitor = SlowConsumerMonitor()
@@ -1,69 +1,173 @@
+import json
+import time
+
+from twisted.internet import defer, task
+
 from stratum.pubsub import Pubsub, Subscription
 from mining.interfaces import Interfaces
+from lib.submit_stats import submit_stats
 
 import lib.settings as settings
 import lib.logger
 log = lib.logger.get_logger('subscription')
 
+def _slice_predicate():
+    '''Ends a cooperator iteration once BROADCAST_TIME_SLICE is used up'''
+    deadline = time.time() + settings.BROADCAST_TIME_SLICE
+    return lambda: time.time() >= deadline
+
+cooperator = task.Cooperator(terminationPredicateFactory=_slice_predicate)
+
 class MiningSubscription(Subscription):
     '''This subscription object implements
     logic for broadcasting new jobs to the clients.'''
     
     event = 'mining.notify'
+
+    broadcast = None # CooperativeTask of the running broadcast
+    broadcast_stats = None
     
     @classmethod
     def on_template(cls, is_new_block):
         '''This is called when TemplateRegistry registers
-           new block which we have to broadcast clients.'''
+           new block which we have to broadcast clients.
+           Miners are notified in time slices, so submits are
+           not stuck behind the whole broadcast.'''
         
-        start = Interfaces.timestamper.time()
+        template = Interfaces.template_registry.last_block
         clean_jobs = is_new_block
-        
-        (job_id, prevhash, coinb1, coinb2, merkle_branch, version, nbits, ntime, nTxTime, _) = \
-            Interfaces.template_registry.get_last_broadcast_args()
 
-        # Push new job to subscribed clients
-        for subscription in Pubsub.iterate_subscribers(cls.event):
+        if cls.broadcast != None:
+            # Remaining miners get the new job instead, and still have to drop the old ones
+            stats = cls.broadcast_stats
+            log.info("Broadcast outdated after %d of %d connections" % (stats['count'], stats['total']))
+            clean_jobs = clean_jobs or stats['clean_jobs']
+            cls.broadcast.stop()
+            cls.broadcast = None
+
+        # Snapshot, subscribers may come and go during the broadcast
+        subscribers = [ s for s in Pubsub.iterate_subscribers(cls.event) if s != None ]
+        if settings.BROADCAST_HIGH_DIFF_FIRST:
+            subscribers.sort(key=cls._get_difficulty, reverse=True)
+
+        stats = {'start': time.time(), 'first': None, 'last': None, 'count': 0,
+                 'total': len(subscribers), 'clean_jobs': clean_jobs}
+        work = cls._broadcast(template, subscribers, clean_jobs, stats)
+
+        if not settings.BROADCAST_TIME_SLICE:
+            for _ in work:
+                pass
+            cls._broadcast_done(None, stats)
+            return defer.succeed(None)
+
+        cls.broadcast = cooperator.cooperate(work)
+        cls.broadcast_stats = stats
+        d = cls.broadcast.whenDone()
+        d.addCallback(cls._broadcast_done, stats)
+        d.addErrback(lambda f: f.trap(task.TaskStopped))
+        return d
+
+    @staticmethod
+    def _get_difficulty(subscription):
+        conn = subscription.connection_ref()
+        if conn == None:
+            return 0
+        return conn.get_session().get('difficulty', 0)
+
+    @classmethod
+    def _broadcast(cls, template, subscribers, clean_jobs, stats):
+        '''Generator notifying one subscriber per iteration'''
+        job_id = template.broadcast_args[0]
+        lines = {}
+
+        for subscription in subscribers:
             try:
-                if subscription != None:
-                    session = subscription.connection_ref().get_session()
-                    session.setdefault('authorized', {})
-                    if session['authorized'].keys():
-                        worker_name = session['authorized'].keys()[0]
-                        difficulty = session['difficulty']
-                        extranonce1_bin = session.get('extranonce1', None)
-                        work_id = Interfaces.worker_manager.register_work(extranonce1_bin, job_id, difficulty)
-                        subscription.emit_single(work_id, prevhash, coinb1, coinb2, merkle_branch, version, nbits, ntime, nTxTime, clean_jobs)          
-                    else:
-                        subscription.emit_single(job_id, prevhash, coinb1, coinb2, merkle_branch, version, nbits, ntime, nTxTime, clean_jobs)
-                    if job_id == '00':
-                        subscription.connection_ref().rpc('mining.set_difficulty', [0,], is_notification=True)
-                    else:
-                        subscription.connection_ref().rpc('mining.set_difficulty', [difficulty,], is_notification=True)
+                conn = subscription.connection_ref()
+                if conn == None:
+                    continue
+                session = conn.get_session()
+                difficulty = session.get('difficulty', settings.POOL_TARGET)
+                if 'jobs' in session:
+                    work_id = session['jobs'].add(job_id, difficulty)
+                else:
+                    work_id = job_id
+                if job_id == '00':
+                    difficulty = 0
+
+                if settings.SIGNING_KEY != None:
+                    data = None
+                elif work_id == job_id:
+                    # Shared by all connections with the same difficulty
+                    data = lines.get(difficulty)
+                    if data == None:
+                        data = lines[difficulty] = cls.serialize_difficulty(difficulty) + \
+                                                   template.serialize_notify(job_id, clean_jobs)
+                else:
+                    # Miners apply the difficulty to the next job, so it goes first
+                    data = cls.serialize_difficulty(difficulty) + template.serialize_notify(work_id, clean_jobs)
+
+                consumer = session.get('consumer')
+                if consumer != None:
+                    consumer.send_job(template, work_id, clean_jobs, difficulty, data)
+                else:
+                    cls.write_job(conn, template, work_id, clean_jobs, difficulty, data)
+
+                stats['last'] = time.time()
+                if stats['first'] == None:
+                    stats['first'] = stats['last']
+                stats['count'] += 1
 
             except Exception as e:
                 log.exception("Error broadcasting work to client %s" % str(e))
-                pass
-        
-        cnt = Pubsub.get_subscription_count(cls.event)
-        log.info("BROADCASTED to %d connections in %.03f sec" % (cnt, (Interfaces.timestamper.time() - start)))
+
+            yield None
+
+    @classmethod
+    def _broadcast_done(cls, _, stats):
+        cls.broadcast = None
+        elapsed = time.time() - stats['start']
+        if stats['count']:
+            (first, last) = (stats['first'] - stats['start'], stats['last'] - stats['start'])
+            submit_stats.record('broadcast_first', first)
+            submit_stats.record('broadcast_last', last)
+        else:
+            (first, last) = (0, 0)
+
+        log.info("BROADCASTED to %d connections in %.03f sec (first miner %.03f, last miner %.03f)" % \
+                 (stats['count'], elapsed, first, last))
+
+    @classmethod
+    def write_job(cls, conn, template, work_id, clean_jobs, difficulty, data=None):
+        '''Sends mining.set_difficulty and mining.notify of the job.
+        Pre-encoded lines (data) bypass Protocol.writeJsonRequest,
+        so with message signing enabled every message is encoded by it.'''
+        if settings.SIGNING_KEY != None:
+            params = [work_id,] + list(template.broadcast_args[1:-1]) + [clean_jobs,]
+            conn.writeJsonRequest('mining.set_difficulty', [difficulty,], is_notification=True)
+            conn.writeJsonRequest('mining.notify', params, is_notification=True)
+            return
+        if data == None:
+            data = cls.serialize_difficulty(difficulty) + template.serialize_notify(work_id, clean_jobs)
+        conn.transport_write(data)
+
+    @staticmethod
+    def serialize_difficulty(difficulty):
+        '''Returns mining.set_difficulty line as Protocol.writeJsonRequest would send it'''
+        return '{"params": [%s], "id": null, "method": "mining.set_difficulty"}\n' % json.dumps(difficulty)
         
     def _finish_after_subscribe(self, result):
         '''Send new job to newly subscribed client'''
-        try:        
-            (job_id, prevhash, coinb1, coinb2, merkle_branch, version, nbits, ntime, nTxTime, _) = \
-                        Interfaces.template_registry.get_last_broadcast_args()
-        except Exception:
+        template = Interfaces.template_registry.last_block
+        if template == None:
             log.error("Template not ready yet")
             return result
         
         # Force set higher difficulty
-        if job_id == '00':
-            self.connection_ref().rpc('mining.set_difficulty', [0,], is_notification=True)
+        if template.broadcast_args[0] == '00':
+            difficulty = 0
         else:
-            self.connection_ref().rpc('mining.set_difficulty', [settings.POOL_TARGET,], is_notification=True)
-        clean_jobs = True
-        self.emit_single(job_id, prevhash, coinb1, coinb2, merkle_branch, version, nbits, ntime, nTxTime, True)
+            difficulty = settings.POOL_TARGET
+        self.write_job(self.connection_ref(), template, template.broadcast_args[0], True, difficulty)
         
         return result
                 
@@ -0,0 +1,374 @@
+'''Multi-process mode: one supervisor and FRONTEND_PROCESSES stratum front-ends.
+
+The supervisor owns the coin daemon connection and the TemplateRegistry
+which is fed by BlockUpdater and block notifications, but doesn't accept
+miners on LISTEN_SOCKET_TRANSPORT. It starts front-ends as processes of
+the same twistd launcher, always in the foreground with their own twistd
+log LOGDIR/frontend-<id>.log, and publishes every new template to them.
+
+Front-ends accept miners on the same port (SO_REUSEPORT, the kernel
+spreads connections), build the published templates with their own
+extranonce prefix and validate shares locally. Share records, found
+blocks and coin daemon calls go back to the supervisor, so there is
+one database writer and one daemon client.
+
+Processes talk over unix socket SUPERVISOR_SOCKET, readable only by
+the pool user, front-ends get its path from the supervisor. Every
+message is a length-prefixed JSON object:
+
+    {"method": "template", "params": [getblocktemplate result]}    supervisor -> front-end
+    {"method": "share", "params": [on_submit_share arguments]}      front-end -> supervisor
+    {"method": "block", "params": [on_submit_block arguments]}      front-end -> supervisor
+    {"method": "update_block", "params": []}                        front-end -> supervisor
+    {"method": "rpc", "id": 1, "params": [method, args, kwargs]}    front-end -> supervisor
+    {"id": 1, "result": ..., "error": null}                          supervisor -> front-end
+'''
+
+import os
+import socket
+import sys
+
+import simplejson as json
+from twisted.internet import defer, protocol, reactor
+from twisted.protocols.basic import Int32StringReceiver
+
+from mining.interfaces import Interfaces, ShareManagerInterface
+
+import lib.settings as settings
+import lib.logger
+log = lib.logger.get_logger('supervisor')
+
+# Set for front-end processes to their instance id
+FRONTEND_ENV = 'STRATUM_FRONTEND_ID'
+# Set for front-end processes to the absolute path of the supervisor socket
+SOCKET_ENV = 'STRATUM_SUPERVISOR_SOCKET'
+
+# Coin daemon calls front-ends may ask for
+RPC_METHODS = ('getblocktemplate', 'submitblock_wtxs', 'validateaddress', 'getinfo', 'getdifficulty')
+
+def get_frontend_id():
+    '''Returns instance id of this front-end process or None in the supervisor'''
+    value = os.environ.get(FRONTEND_ENV)
+    if value == None:
+        return None
+    return int(value)
+
+def get_supervisor_socket():
+    '''Returns path of the supervisor socket in a front-end process'''
+    return os.environ[SOCKET_ENV]
+
+class MessageProtocol(Int32StringReceiver):
+    # Templates of full blocks are large
+    MAX_LENGTH = 64 * 1024 * 1024
+
+    def send(self, method, params, message_id=None):
+        self.sendString(json.dumps({'method': method, 'params': params, 'id': message_id}))
+
+    def stringReceived(self, data):
+        try:
+            self.message_received(json.loads(data))
+        except Exception:
+            log.exception("Processing of message failed")
+
+    def lengthLimitExceeded(self, length):
+        log.error("Message of %d bytes is too long" % length)
+        self.transport.loseConnection()
+
+class SupervisorProtocol(MessageProtocol):
+    '''Connection of one front-end in the supervisor'''
+
+    def connectionMade(self):
+        self.factory.frontends.append(self)
+        if self.factory.template_message != None:
+            self.sendString(self.factory.template_message)
+
+    def connectionLost(self, reason):
+        if self in self.factory.frontends:
+            self.factory.frontends.remove(self)
+
+    def message_received(self, message):
+        method = message.get('method')
+        params = message.get('params')
+
+        if method == 'share':
+            Interfaces.share_manager.on_submit_share(*params)
+        elif method == 'block':
+            Interfaces.share_manager.on_submit_block(*params)
+        elif method == 'update_block':
+            self.factory.update_block()
+        elif method == 'rpc':
+            (name, args, kwargs) = params
+            if name not in RPC_METHODS:
+                self.sendString(json.dumps({'id': message['id'], 'result': None,
+                                            'error': "Method %s is not allowed" % name}))
+                return
+            kwargs = dict((str(k), v) for (k, v) in kwargs.items())
+            d = defer.maybeDeferred(getattr(self.factory.bitcoin_rpc, name), *args, **kwargs)
+            d.addCallbacks(self._rpc_result, self._rpc_error,
+                           callbackArgs=(message['id'],), errbackArgs=(message['id'],))
+        else:
+            log.error("Unknown message %s from front-end" % method)
+
+    def _rpc_result(self, result, message_id):
+        self.sendString(json.dumps({'id': message_id, 'result': result, 'error': None}))
+
+    def _rpc_error(self, failure, message_id):
+        self.sendString(json.dumps({'id': message_id, 'result': None, 'error': failure.getErrorMessage()}))
+
+class Supervisor(protocol.ServerFactory):
+    '''Publishes templates to front-ends and keeps them running'''
+    protocol = SupervisorProtocol
+
+    def __init__(self, bitcoin_rpc, on_template):
+        self.bitcoin_rpc = bitcoin_rpc
+        self.on_template_callback = on_template
+        self.registry = None
+        self.path = None
+        self.frontends = []
+        self.template_message = None # Serialized once, sent to every front-end
+        self.processes = {}
+        self.stopping = False
+
+    def on_template(self, is_new_block):
+        '''Registry callback, miners of the supervisor (if any)
+        get the job and front-ends the template'''
+        self.on_template_callback(is_new_block)
+        if self.registry == None:
+            # First template is built before start()
+            return
+        self._set_template(self.registry.last_data)
+        for frontend in self.frontends:
+            frontend.sendString(self.template_message)
+
+    def _set_template(self, data):
+        if data == None:
+            self.template_message = None
+        else:
+            self.template_message = json.dumps({'method': 'template', 'params': [data], 'id': None})
+
+    def start(self, registry, path, count):
+        self.registry = registry
+        self._set_template(registry.last_data)
+
+        # Front-ends may run in another working directory
+        self.path = path = os.path.abspath(path)
+        directory = os.path.dirname(path)
+        if not os.path.isdir(directory):
+            # Not accessible to other users, closes the window before chmod of the socket
+            os.makedirs(directory, 0700)
+        if os.path.exists(path):
+            # Left over by previous run
+            os.unlink(path)
+        reactor.listenUNIX(path, self, mode=0600)
+        log.info("Supervisor listening on %s" % path)
+
+        # Instance ids of front-ends, the supervisor keeps INSTANCE_ID
+        instance_ids = [ i for i in xrange(1 << settings.EXTRANONCE_INSTANCE_BITS) if i != settings.INSTANCE_ID ][:count]
+        if len(instance_ids) < count:
+            log.error("Only %d front-ends fit in %d EXTRANONCE_INSTANCE_BITS" % \
+                      (len(instance_ids), settings.EXTRANONCE_INSTANCE_BITS))
+        for instance_id in instance_ids:
+            self.spawn(instance_id)
+        reactor.addSystemEventTrigger('before', 'shutdown', self.stop)
+
+    def spawn(self, instance_id):
+        if self.stopping:
+            return
+        env = dict(os.environ)
+        env[FRONTEND_ENV] = str(instance_id)
+        env[SOCKET_ENV] = self.path
+        # Front-ends run the same twistd command, without pid file of the supervisor.
+        # Options given later win, so whatever the operator passed, front-ends
+        # stay children of the supervisor and don't share its twistd log.
+        # sys.executable is empty once twistd changed the process name.
+        executable = sys.executable or os.path.realpath('/proc/self/exe')
+        logdir = os.path.abspath(settings.LOGDIR)
+        if not os.path.isdir(logdir):
+            os.makedirs(logdir)
+        args = [executable] + sys.argv + ['--pidfile=', '--nodaemon',
+                '--logfile=%s' % os.path.join(logdir, 'frontend-%d.log' % instance_id)]
+        self.processes[instance_id] = reactor.spawnProcess(FrontendProcess(self, instance_id),
+                executable, args, env=env, childFDs={0: 0, 1: 1, 2: 2})
+        log.info("Started front-end %d, pid %d" % (instance_id, self.processes[instance_id].pid))
+
+    def update_block(self):
+        '''Block notification received by a front-end, the new template
+        is published to all of them'''
+        if self.registry != None:
+            self.registry.update_block()
+
+    def stop(self):
+        self.stopping = True
+        for process in self.processes.values():
+            try:
+                process.signalProcess('TERM')
+            except Exception:
+                pass
+
+    def get_stats(self):
+        return {'frontends': len(self.frontends), 'processes': sorted(self.processes.keys())}
+
+class FrontendProcess(protocol.ProcessProtocol):
+    def __init__(self, supervisor, instance_id):
+        self.supervisor = supervisor
+        self.instance_id = instance_id
+
+    def processEnded(self, reason):
+        self.supervisor.processes.pop(self.instance_id, None)
+        if not self.supervisor.stopping:
+            log.error("Front-end %d exited (%s), restarting" % (self.instance_id, reason.getErrorMessage()))
+            reactor.callLater(1, self.supervisor.spawn, self.instance_id)
+
+class FrontendProtocol(MessageProtocol):
+    '''Connection of front-end to the supervisor'''
+
+    def connectionMade(self):
+        self.factory.client.connection_made(self)
+
+    def connectionLost(self, reason):
+        self.factory.client.connection_lost(reason)
+
+    def message_received(self, message):
+        if message.get('method') == 'template':
+            self.factory.client.template_received(message['params'][0])
+        else:
+            self.factory.client.reply_received(message['id'], message['result'], message['error'])
+
+class SupervisorClient(object):
+    '''Used by front-ends in place of BitcoinRPC, calls are made
+    by the supervisor. Also applies published templates to the registry.'''
+
+    def __init__(self, path):
+        self.path = path
+        self.bitcoin_url = 'supervisor %s' % path
+        self.connection = None
+        self.on_connect = defer.Deferred()
+        self.calls = {}
+        self.counter = 0
+        self.registry = None
+        self.pending = None
+        self.updating = False
+        self.templates = 0
+
+    def connect(self):
+        factory = protocol.ClientFactory()
+        factory.protocol = FrontendProtocol
+        factory.client = self
+        factory.clientConnectionFailed = lambda connector, reason: self.on_connect.errback(reason)
+        reactor.connectUNIX(self.path, factory)
+        return self.on_connect
+
+    def connection_made(self, connection):
+        self.connection = connection
+        self.on_connect.callback(self)
+
+    def connection_lost(self, reason):
+        # Front-end can't work without templates, supervisor starts new one
+        log.error("Connection to supervisor lost: %s" % reason.getErrorMessage())
+        self.connection = None
+        (calls, self.calls) = (self.calls, {})
+        for d in calls.values():
+            d.errback(Exception("Connection to supervisor lost"))
+        if reactor.running:
+            reactor.stop()
+
+    def _call(self, method, *args, **kwargs):
+        if self.connection == None:
+            return defer.fail(Exception("Not connected to supervisor"))
+        self.counter += 1
+        d = self.calls[self.counter] = defer.Deferred()
+        self.connection.send('rpc', [method, args, kwargs], self.counter)
+        return d
+
+    def reply_received(self, message_id, result, error):
+        d = self.calls.pop(message_id, None)
+        if d == None:
+            log.error("Reply to unknown call %s from supervisor" % message_id)
+            return
+        if error != None:
+            d.errback(Exception(error))
+        else:
+            d.callback(result)
+
+    def getblocktemplate(self, raw=False):
+        return self._call('getblocktemplate', raw=raw)
+
+    def submitblock_wtxs(self, block_hex, txs, block_hash_hex):
+        return self._call('submitblock_wtxs', block_hex, txs, block_hash_hex)
+
+    def validateaddress(self, address):
+        return self._call('validateaddress', address)
+
+    def getinfo(self):
+        return self._call('getinfo')
+
+    def getdifficulty(self):
+        return self._call('getdifficulty')
+
+    def send(self, method, params):
+        if self.connection != None:
+            self.connection.send(method, params)
+
+    def update_block(self):
+        '''Asks the supervisor to poll the coin daemon'''
+        self.send('update_block', [])
+
+    def set_registry(self, registry):
+        self.registry = registry
+        self._update()
+
+    def template_received(self, data):
+        self.templates += 1
+        self.pending = data
+        self._update()
+
+    def _update(self):
+        if self.registry == None or self.updating or self.pending == None:
+            return
+        d = self.registry.update_block(self.pending)
+        if d == None:
+            # The registry is still building its first template
+            reactor.callLater(0.1, self._update)
+            return
+        self.pending = None
+        self.updating = True
+        d.addBoth(self._updated)
+
+    def _updated(self, _):
+        self.updating = False
+        self._update()
+
+    def get_stats(self):
+        return {'calls': self.counter, 'pending_calls': len(self.calls), 'templates': self.templates}
+
+class FrontendShareManager(ShareManagerInterface):
+    '''Forwards share records and found blocks to the share manager of the supervisor'''
+
+    def __init__(self, client):
+        ShareManagerInterface.__init__(self)
+        self.client = client
+
+    def on_network_block(self):
+        # Handled by the supervisor
+        pass
+
+    def on_submit_share(self, worker_name, block_hash, difficulty, timestamp, is_valid, ip, invalid_reason, share_diff, job_id):
+        self.client.send('share', [worker_name, block_hash, difficulty, timestamp, is_valid, ip,
+                                   invalid_reason, share_diff, job_id])
+
+    def on_submit_block(self, is_accepted, worker_name, block_hash, timestamp, ip, share_diff):
+        self.client.send('block', [is_accepted, worker_name, block_hash, timestamp, ip, share_diff])
+
+def listen_reuseport(port, factory, interface=''):
+    '''Listens on TCP port shared with the other front-ends'''
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    # Python 2 doesn't define the constant, 15 on Linux
+    sock.setsockopt(socket.SOL_SOCKET, getattr(socket, 'SO_REUSEPORT', 15), 1)
+    sock.bind((interface, port))
+    sock.listen(socket.SOMAXCONN)
+    sock.setblocking(False)
+    listening = reactor.adoptStreamPort(sock.fileno(), socket.AF_INET, factory)
+    # The reactor has its own copy of the descriptor
+    sock.close()
+    return listening
@@ -3,6 +3,11 @@
 # You can use this script directly as an variable for -blocknotify argument:
 # 	./litecoind -blocknotify="blocknotify.sh --password admin_password"
 # This is also very basic example how to use Stratum protocol in native Python
+#
+# Faster alternative without starting python and Stratum handshake is the datagram
+# endpoint of the pool (BLOCKNOTIFY_LISTEN and BLOCKNOTIFY_SECRET in conf/config.py):
+# 	./litecoind -blocknotify="bash -c 'echo secret %s $EPOCHREALTIME > /dev/udp/127.0.0.1/3334'"
+# 	./litecoind -blocknotify="sh -c 'echo secret %s | socat - UNIX-SENDTO:/tmp/stratum-blocknotify.sock'"
 
 import socket
 import json